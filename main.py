@@ -9,19 +9,27 @@ Created on Sat Oct 12 12:22:29 2024
 import numpy as np
 import pandas as pd
 from scipy.constants import speed_of_light
+from scipy.special import j0
+from scipy.stats import norm
 
 import time
+from functools import lru_cache, partial, reduce
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
 
 import matplotlib.pyplot as plt
 import matplotlib.colors as mcolors
 from matplotlib.ticker import MaxNLocator
 import tikzplotlib
 
-from sklearn.linear_model import LinearRegression
 from sklearn.cluster import KMeans
 from sklearn.ensemble import RandomForestClassifier
+from threadpoolctl import threadpool_limits
 
 import os
+import pickle
+import copy
+import hashlib
 
 from tensorflow import keras
 from tensorflow.keras import layers, losses
@@ -57,8 +65,18 @@ N_sc = 64                                # Number of subcarriers
 P_BS = 4                                 # Base station transmit power [W] (across all transmitters)
 
 max_transmissions = 300
+transmission_batch_size = 100            # Transmissions simulated at once (caps memory)
+n_workers = 1                            # Processes for the SNR sweep (1 runs serially)
+
+# Adaptive stopping of an SNR point before max_transmissions
+target_block_errors = np.inf             # Stop at this many block errors
+target_bit_errors = np.inf               # Stop at this many bit errors
+bler_relative_precision = 0.             # Stop when the BLER interval half-width is below this fraction of BLER (0: off)
+confidence_level = 0.95                  # Confidence level of the BLER interval
+
+checkpoint_path = None                   # Directory for checkpoints of completed SNR points (None: off)
 precoder = 'identity'                    # Also: identity, SVD, SVD_Waterfilling, dft_beamforming
-channel_type = 'CDL-E'                   # Channel type: rayleigh, ricean, CDL-C, CDL-E
+channel_type = 'CDL-E'                   # Channel type: rayleigh, ricean, CDL-A, CDL-B, CDL-C, CDL-D, CDL-E
 quantization_b = np.inf                  # Quantization resolution
 
 Df = 15e3                                # OFDM subcarrier bandwidth [Hz].
@@ -70,11 +88,11 @@ constellation = 'QAM'                    # QAM or PSK
 M_constellation = 16                     # Square constellations only.
 n_pilot = 4                              # Number of pilots for channel estimation
 
-MIMO_estimation = 'perfect'              # Also: perfect, LS, LMMSE
+MIMO_estimation = 'perfect'              # Also: perfect, LS, LMMSE, regression
 MIMO_equalization = 'MMSE'               # Also: MMSE, ZF
 symbol_detection = 'ML'                  # Also: ML, kmeans, DNN, ensemble
 
-crc_generator = 0b1100_0100              # CRC generator polynomial
+crc_generator = 0b1100_0100              # CRC generator polynomial (x^7 + x^6 + x^2)
 channel_compression_ratio = 0            # Channel compression
 
 # Transmit SNR in dB
@@ -94,14 +112,52 @@ __ver__ = '0.7'
 __data__ = '2024-12-07'
 
 
-def create_bit_payload(payload_size):
+class SimulationConfig:
+    '''
+        The parameters, algorithms, and random stream of one simulation.
+        Parameters that are not given default to the module parameters above.
+        The random stream defaults to np_random, or to a new stream if a seed is given.
+    '''
+    parameters = ['P_BS', 'max_transmissions', 'transmission_batch_size', 'n_workers',
+                  'target_block_errors', 'target_bit_errors', 'bler_relative_precision', 'confidence_level',
+                  'precoder', 'channel_type', 'quantization_b', 'Df', 'f_c',
+                  'interference_power_dBm', 'p_interference', 'n_pilot',
+                  'MIMO_estimation', 'MIMO_equalization', 'symbol_detection',
+                  'channel_compression_ratio', 'seed', 'checkpoint_path']
+
+    def __init__(self, np_random=None, **kwargs):
+        unknown = set(kwargs) - set(self.parameters)
+        if len(unknown) > 0:
+            raise ValueError(f'Unknown simulation parameters {sorted(unknown)}.')
+
+        module_parameters = globals()
+        for name in self.parameters:
+            setattr(self, name, kwargs.get(name, module_parameters[name]))
+
+        if np_random is None:
+            np_random = np.random.RandomState(seed=self.seed) if 'seed' in kwargs else module_parameters['np_random']
+
+        self.np_random = np_random
+
+    def fingerprint(self, *args):
+        # A short hash of the parameters that change the results, and of args.
+        parameters = [(name, getattr(self, name)) for name in self.parameters
+                      if name not in ['n_workers', 'checkpoint_path']]
+
+        return hashlib.sha1(repr((parameters, args)).encode()).hexdigest()[:16]
+
+
+def create_bit_payload(payload_size, random_state=None):
     global np_random
-    bits = np_random.binomial(1, 0.5, size=payload_size)
-    bits = ''.join(map(str, bits))
+
+    random_state = np_random if random_state is None else random_state
+    bits = random_state.binomial(1, 0.5, size=payload_size).astype(np.uint8)
     return bits
 
 
+@lru_cache(maxsize=None)
 def create_constellation(constellation, M):
+    # Constellations are built once per (constellation, M) and then reused.
     if (constellation == 'PSK'):
         return _create_constellation_psk(M)
     elif (constellation == 'QAM'):
@@ -110,11 +166,49 @@ def create_constellation(constellation, M):
         return None
 
 
-def decimal_to_gray(n, k):
-    gray = n ^ (n >> 1)
-    gray = bin(gray)[2:]
+class Constellation:
+    # A read-only constellation in contiguous arrays: the complex points,
+    # their integer labels m, and the (M x k) matrix of their Gray code bits.
+    def __init__(self, kind, points, bits, levels=None, grid_to_label=None):
+        self.kind = kind
+        self.M = points.shape[0]
+        self.k = int(np.log2(self.M))
+
+        self.points = np.ascontiguousarray(points, dtype=np.complex128)
+        self.labels = np.arange(self.M)  # This is also the row index.
+        self.bits = np.ascontiguousarray(bits, dtype=np.uint8)
+
+        # Gray code of each point and its inverse to look up a point from its bits.
+        self.codes = self.bits @ (1 << np.arange(self.k - 1, -1, -1))
+        self.code_to_label = np.argsort(self.codes)
+
+        # Square QAM only: the normalized PAM levels per axis and the
+        # label of the point at each (I level, Q level).
+        self.levels = levels
+        self.grid_to_label = grid_to_label
+
+        for array in [self.points, self.labels, self.bits, self.codes, self.code_to_label,
+                      self.levels, self.grid_to_label]:
+            if array is not None:
+                array.flags.writeable = False
+
+    def to_dataframe(self):
+        # Only needed for plotting.
+        bits = self.bits.astype(str)
+        constellation = pd.DataFrame(data={'m': self.labels,
+                                           'x_I': np.real(self.points),
+                                           'x_Q': np.imag(self.points)})
+        constellation['I'] = [''.join(b) for b in bits[:, :(self.k//2)]]
+        constellation['Q'] = [''.join(b) for b in bits[:, (self.k//2):]]
+        constellation['x'] = self.points
+
+        return constellation
 
-    return '{}'.format(gray).zfill(k)
+
+def _gray_code(n, k):
+    # The k Gray code bits of every integer in n.
+    gray = n ^ (n >> 1)
+    return ((gray[:, None] >> np.arange(k - 1, -1, -1)) & 1).astype(np.uint8)
 
 
 # Constellation based on Gray code
@@ -125,103 +219,77 @@ def _create_constellation_psk(M):
         return None
 
     k = int(k)
-    constellation = pd.DataFrame(columns=['m', 'x_I', 'x_Q'])
-
-    for m in np.arange(M):
-        centroid_ = pd.DataFrame(data={'m': int(m),
-                                       'x_I': np.sqrt(1 / 2) * np.cos(2*np.pi/M*m + np.pi/M),
-                                       'x_Q': np.sqrt(1 / 2) * np.sin(2*np.pi/M*m + np.pi/M)}, index=[m])
-        if constellation.shape[0] == 0:
-            constellation = centroid_.copy()
-        else:
-            constellation = pd.concat([constellation, centroid_], ignore_index=True)
-
-    gray = constellation['m'].apply(lambda x: decimal_to_gray(x, k))
-    constellation['I'] = gray.str[:(k//2)]
-    constellation['Q'] = gray.str[(k//2):]
+    m = np.arange(M)
 
-    constellation.loc[:, 'x'] = constellation.loc[:, 'x_I'] + 1j * constellation.loc[:, 'x_Q']
+    x = np.sqrt(1 / 2) * np.exp(1j * (2*np.pi/M*m + np.pi/M))
 
     # Normalize the transmitted symbols
     # The average power is normalized to unity
-    P_average = np.mean(np.abs(constellation.loc[:, 'x']) ** 2)
-    constellation.loc[:, 'x'] /= np.sqrt(P_average)
+    P_average = _signal_power(x)
+    x /= np.sqrt(P_average)
 
-    return constellation
+    return Constellation('PSK', points=x, bits=_gray_code(m, k))
 
 
 # Constellation based on Gray code
 def _create_constellation_qam(M):
     k = np.log2(M)
-    if k != int(k):  # only square QAM is allowed.
+    if k != int(k) or int(k) % 2 != 0:  # only square QAM is allowed.
         print('Only square QAM constellations allowed.')
         return None
 
     k = int(k)
     m = np.arange(M)
-    Am_ = np.arange(-np.sqrt(M) + 1, np.sqrt(M), step=2, dtype=int)  # Proakis p105
-
-    Am = np.zeros(M, dtype=np.complex64)
-    idx = 0
-    for Am_I in Am_:
-        for Am_Q in Am_:
-            Am[idx] = Am_I + 1j * Am_Q
-            idx += 1
-
-    # This will hold the transmitted symbols
-    constellation = pd.DataFrame(data={'x_I': np.real(Am),
-                                       'x_Q': np.imag(Am)})
-    constellation.insert(0, 'm', m)
-    constellation_ordered = pd.DataFrame()
-    for idx, s in enumerate(np.array_split(constellation, int(np.sqrt(M)))):
-        if idx % 2 == 1:
-            s = s.iloc[::-1]  # Invert
-        # print(s)
-        constellation_ordered = pd.concat([constellation_ordered, s], axis=0)
-
-    constellation = constellation_ordered.copy()
-    constellation = constellation.reset_index(drop=True)
-    constellation['m'] = constellation.index
-
-    gray = constellation['m'].apply(lambda x: decimal_to_gray(x, k))
-    constellation['I'] = gray.str[:(k//2)]
-    constellation['Q'] = gray.str[(k//2):]
-
-    constellation.loc[:, 'x'] = constellation.loc[:, 'x_I'] + \
-        1j * constellation.loc[:, 'x_Q']
+    sqrt_M = int(np.sqrt(M))
+    Am_ = np.arange(-sqrt_M + 1, sqrt_M, step=2, dtype=int)  # Proakis p105
+
+    # Points are ordered column by column (fixed I) and every other
+    # column is inverted so that neighbors differ in one Gray code bit.
+    idx_I = m // sqrt_M
+    idx_Q = m % sqrt_M
+    idx_Q = np.where(idx_I % 2 == 1, sqrt_M - 1 - idx_Q, idx_Q)
+
+    x = Am_[idx_I] + 1j * Am_[idx_Q]
+
+    grid_to_label = np.zeros((sqrt_M, sqrt_M), dtype=int)
+    grid_to_label[idx_I, idx_Q] = m
 
     # Normalize the transmitted symbols
     # The average power is normalized to unity
-    P_average = _signal_power(constellation['x'])  # np.mean(np.abs(constellation.loc[:, 'x']) ** 2)
-    constellation.loc[:, 'x'] /= np.sqrt(P_average)
+    P_average = _signal_power(x)
+    x /= np.sqrt(P_average)
+    levels = Am_ / np.sqrt(P_average)
 
-    return constellation
+    return Constellation('QAM', points=x, bits=_gray_code(m, k),
+                         levels=levels, grid_to_label=grid_to_label)
 
 
 def _signal_power(signal):
     return np.mean(np.abs(signal) ** 2, axis=0)
 
 
-def generate_transmit_symbols(N_sc, N_t, alphabet, P_TX):
-    global np_random
-    global crc_generator
+def _average_power(signal):
+    # Average power of each (N_sc, N) transmission; leading axes are a batch.
+    return np.mean(np.abs(signal) ** 2, axis=(-2, -1))
 
-    k = int(np.log2(alphabet.shape[0]))
+
+def generate_transmit_symbols(N_sc, N_t, alphabet, P_TX, crc_generator, random_state=None):
+    k = alphabet.k
 
     payload_length = N_sc * N_t * k  # For the future, this depends on the MCS index.
 
-    crc_length = len(bin(crc_generator)[2:])  # in bits.
+    crc_length = crc_generator.bit_length() - 1  # in bits (degree of the generator).
     crc_pad_length = int(np.ceil(crc_length / k)) * k  # padding included.
 
     padding_length = crc_pad_length - crc_length
 
-    bits = create_bit_payload(payload_length)
+    bits = create_bit_payload(payload_length, random_state=random_state)
 
     bits = bits[:-crc_pad_length]
     crc_transmitter = compute_crc(bits, crc_generator)
 
     # Construct the payload frame.
-    payload = bits + '0' * padding_length + crc_transmitter
+    payload = np.r_[bits, np.zeros(padding_length, dtype=np.uint8), crc_transmitter]
     assert(len(payload) == payload_length)
 
     x_b_i, x_b_q, x_information, x_symbols = bits_to_baseband(payload, alphabet)
@@ -232,35 +300,37 @@ def generate_transmit_symbols(N_sc, N_t, alphabet, P_TX):
     # Normalize and scale the transmit power of the symbols.
     x_symbols /= np.sqrt(_signal_power(x_symbols).mean() / P_TX)
 
-    x_b_i = np.reshape(x_b_i, (-1, N_t))
-    x_b_q = np.reshape(x_b_q, (-1, N_t))
+    x_b_i = np.reshape(x_b_i, (N_sc, N_t, -1))
+    x_b_q = np.reshape(x_b_q, (N_sc, N_t, -1))
 
     return x_information, x_symbols, [x_b_i, x_b_q], payload_length, crc_transmitter
 
 
-def generate_interference(Y, p_interference, interference_power_dBm):
+def generate_interference(Y, p_interference, interference_power_dBm, random_state=None):
     global np_random
 
-    N_sc, N_r = Y.shape
+    random_state = np_random if random_state is None else random_state
 
+    # Y is (N_sc, N_r) or a batch of transmissions (..., N_sc, N_r).
     interference_power = _linear(interference_power_dBm)
 
     interf = np.sqrt(interference_power / 2) * \
-        (np_random.normal(0, 1, size=(N_sc, N_r)) + \
-         1j * np_random.normal(0, 1, size=(N_sc, N_r)))
+        (random_state.normal(0, 1, size=Y.shape) + \
+         1j * random_state.normal(0, 1, size=Y.shape))
 
-    mask = np_random.binomial(n=1, p=p_interference, size=N_sc)
+    mask = random_state.binomial(n=1, p=p_interference, size=Y.shape[:-1])
 
     # Apply some changes to interference
-    for idx in range(N_sc):
-        interf[idx, :] *= mask[idx]
+    interf *= mask[..., np.newaxis]
 
     return interf
 
 
-def generate_pilot_symbols(N_t, n_pilot, P_TX, kind='dft'):
+def generate_pilot_symbols(N_t, n_pilot, P_TX, kind='dft', random_state=None):
     global np_random
 
+    random_state = np_random if random_state is None else random_state
+
     if kind == 'dft':
         n_generation = max(N_t, n_pilot)
 
@@ -275,8 +345,8 @@ def generate_pilot_symbols(N_t, n_pilot, P_TX, kind='dft'):
 
     if kind == 'qr':
         # Generate a random complex Gaussian matrix
-        random_matrix = np.sqrt(1 / 2) * (np_random.randn(n_pilot, N_t) + \
-                                          1j * np_random.randn(n_pilot, N_t))
+        random_matrix = np.sqrt(1 / 2) * (random_state.randn(n_pilot, N_t) + \
+                                          1j * random_state.randn(n_pilot, N_t))
 
         # Perform QR decomposition on the random matrix to get a unitary matrix
         Q, R = np.linalg.qr(random_matrix)
@@ -287,7 +357,7 @@ def generate_pilot_symbols(N_t, n_pilot, P_TX, kind='dft'):
     if kind == 'semi-unitary':
         # Compute a unitary matrix from a combinatoric of e
         I = np.eye(N_t)
-        idx = np_random.choice(range(N_t), size=N_t, replace=False)
+        idx = random_state.choice(range(N_t), size=N_t, replace=False)
         Q = I[:, idx]
 
         assert(np.allclose(Q@Q.T, np.eye(N_t)))  # Q is indeed unitary, but square.
@@ -311,205 +381,331 @@ def generate_pilot_symbols(N_t, n_pilot, P_TX, kind='dft'):
 
 
 def bits_to_baseband(x_bits, alphabet):
-    k = int(np.log2(alphabet.shape[0]))
-
-    df_ = alphabet[['m', 'I', 'Q']].copy()
-    df_.loc[:, 'IQ'] = df_['I'].astype(str) + df_['Q'].astype(str)
-
-    x_b_rev = x_bits[::-1]
-    x_b_i = []
-    x_b_q = []
-    while len(x_b_rev) > 0:
-        codeword = x_b_rev[:k][::-1].zfill(k)
-        # print(codeword)
-        x_b_i.append(codeword[:(k//2)])
-        x_b_q.append(codeword[(k//2):])
+    k = alphabet.k
 
-        #print(x_b_rev, x_b_i)
-        x_b_rev = x_b_rev[k:]
+    # The last axis holds the bits of one transmission; any leading axes
+    # are a batch of transmissions.
+    x_bits = np.asarray(x_bits, dtype=np.uint8)
 
-    x_b_i = x_b_i[::-1]
-    x_b_q = x_b_q[::-1]
+    # Group the bits into k-bit codewords, then turn each codeword into its integer label.
+    codewords = x_bits.reshape(x_bits.shape[:-1] + (-1, k))
+    codes = codewords @ (1 << np.arange(k - 1, -1, -1))
 
-    x_sym = []
-    x_info = []
+    # Next is baseband which is the complex valued symbols (one gather).
+    x_info = alphabet.code_to_label[codes]
+    x_sym = alphabet.points[x_info]
+    x_b_i = codewords[..., :(k//2)]
+    x_b_q = codewords[..., (k//2):]
 
-    # Next is baseband which is the complex valued symbols
-    for i, q in zip(x_b_i, x_b_q):
-        sym = alphabet.loc[(alphabet['I'] == i) & (alphabet['Q'] == q), 'x'].values[0]
-        info = int(alphabet.loc[(alphabet['I'] == i) & (alphabet['Q'] == q), 'm'].values[0])
+    return x_b_i, x_b_q, x_info, x_sym
 
-        x_sym.append(sym)
-        x_info.append(info)
 
-    x_sym = np.array(x_sym)
-    x_info = np.array(x_info)
+def _symbols_from_labels(labels, alphabet, shape):
+    # Map detected labels back to information, symbols, and bits.
+    k = alphabet.k
+    bits = alphabet.bits[labels]
 
-    return x_b_i, x_b_q, x_info, x_sym
+    information = alphabet.labels[labels].reshape(shape)
+    symbols = alphabet.points[labels].reshape(shape)
+    bits_i = bits[..., :(k//2)].reshape(shape + (-1,))
+    bits_q = bits[..., (k//2):].reshape(shape + (-1,))
 
+    return information, symbols, [bits_i, bits_q]
 
-def channel_effect(H, X, snr_dB):
-    global np_random
-    global precoder
 
-    N_sc = H.shape[0]
+def channel_effect(H, X, snr_dB, out=None, config=None):
+    config = SimulationConfig() if config is None else config
 
+    # X is (N_sc, N_t) or a batch of transmissions (..., N_sc, N_t).
     # Set a flag to deal with beamforming.
-    is_beamforming = True
+    is_beamforming = (H.ndim == 2)
     N_r = 1
 
     # Parameters
-    if len(H.shape) == 3:  # MIMO case
-        _, N_r, N_t = H.shape
-        is_beamforming = False
-        if N_t > 1 and N_r == 1 and precoder != 'dft_beamforming':
+    if not is_beamforming:  # MIMO case
+        N_r, N_t = H.shape[-2:]
+        if N_t > 1 and N_r == 1 and config.precoder != 'dft_beamforming':
             raise ValueError('Only beamforming is supported for MISO.  Check the setting of precoder.')
 
     # Convert SNR from dB to linear scale
     snr_linear = _linear(snr_dB)
 
-    # Compute the power of the transmit matrix X
-    signal_power = np.mean(_signal_power(X))  # This must equal P_BS / N_t.
+    # Compute the power of each transmit matrix X
+    signal_power = _average_power(X)[..., np.newaxis, np.newaxis]  # This must equal P_BS / N_t.
 
     # Calculate the noise power based on the input SNR
     noise_power = signal_power / snr_linear
 
     # Generate additive white Gaussian noise (AWGN)
-    noise = np.sqrt(noise_power / 2) * (np_random.randn(N_sc, N_r) + 1j * np_random.randn(N_sc, N_r))
+    size = X.shape[:-1] + (N_r,)
+    noise = np.sqrt(noise_power / 2) * (config.np_random.randn(*size) + 1j * config.np_random.randn(*size))
 
-    received_signal = np.zeros((N_sc, N_r), dtype=np.complex128)
-
-    if is_beamforming:
-        received_signal = H*X + noise
-        return received_signal, noise
-
-    for sc in range(N_sc):
-        received_signal[sc, :] = H[sc, :, :] @ X[sc, :] + noise[sc, :]
+    received_signal = _matrix_vector_multiplication(H, X, out=out)
+    received_signal += noise
 
     return received_signal, noise
 
 
 def equalize_channel(H, snr_dB, algorithm):
+    if algorithm not in ['ZF', 'MMSE']:
+        return None
+
+    # A frequency-flat channel has one equalizer for all subcarriers.
+    # Equalizers of a coherence block are reused through CoherenceBlockCache.
+    if _is_frequency_flat(H):
+        W = _equalize(H[..., :1, :, :], snr_dB, algorithm)
+        return np.broadcast_to(W, H.shape[:-2] + W.shape[-2:])
+
+    return _equalize(H, snr_dB, algorithm)
+
+
+def _equalize(H, snr_dB, algorithm):
     if algorithm == 'ZF':
         return _equalize_channel_ZF(H)
 
-    if algorithm == 'MMSE':
-        return _equalize_channel_MMSE(H, snr_dB)
+    return _equalize_channel_MMSE(H, snr_dB)
 
-    return None
 
+def _is_frequency_flat(H):
+    # All the subcarriers (axis -3) carry the same matrix.  Flat channels are
+    # stored as one matrix with a zero stride on the subcarrier axis.
+    return H.shape[-3] == 1 or H.strides[-3] == 0 or np.all(H == H[..., :1, :, :])
 
-def _equalize_channel_ZF(H):
-    N_sc, N_r, N_t = H.shape
 
-    # Hermitian transpose of each subcarrier's H: (N_sc, N_t, N_r)
-    H_hermitian = np.conjugate(np.transpose(H, (0, 2, 1)))
+def _broadcast_subcarriers(H, N_sc):
+    # A read-only view of the matrices H (..., m, n) on N_sc subcarriers: (..., N_sc, m, n).
+    return np.broadcast_to(H[..., np.newaxis, :, :], H.shape[:-2] + (N_sc,) + H.shape[-2:])
 
-    # (H^H * H) for all subcarriers: (N_sc, N_t, N_t)
-    H_herm_H = np.matmul(H_hermitian, H)
 
-    # Compute the pseudo-inverse for each subcarrier (to handle singularity)
-    H_pseudo_inv = np.linalg.pinv(H_herm_H)  # Shape (N_sc, N_t, N_t)
+def _channel_product(*matrices):
+    # The product of per-subcarrier matrices (..., N_sc, m, n).  If all are
+    # stored as frequency-flat, it is computed on one subcarrier and stays flat.
+    if not all(M.ndim >= 3 and M.strides[-3] == 0 for M in matrices):
+        return reduce(np.matmul, matrices)
 
-    # ZF equalization matrix: (H^H * H)^-1 * H^H for all subcarriers
-    W_zf = np.matmul(H_pseudo_inv, H_hermitian)  # Shape (N_sc, N_t, N_r)
+    product = reduce(np.matmul, [M[..., 0, :, :] for M in matrices])
+    return _broadcast_subcarriers(product, matrices[0].shape[-3])
 
-    return W_zf
+
+def _equalize_channel_ZF(H):
+    # H is (N_sc, N_r, N_t) or a batch (..., N_sc, N_r, N_t).
+    # ZF equalization matrix: (H^H * H)^-1 * H^H for all subcarriers
+    return _regularized_pseudo_inverse(H, regularization=0)  # Shape (N_sc, N_t, N_r)
 
 
 def _equalize_channel_MMSE(H, snr_dB):
-    N_sc, N_r, N_t = H.shape
     snr_linear = _linear(snr_dB)
 
+    # MMSE equalization matrix: (H^H * H + (1/SNR) * I)^-1 * H^H
+    return _regularized_pseudo_inverse(H, regularization=1 / snr_linear)  # Shape (N_sc, N_t, N_r)
+
+
+def _regularized_pseudo_inverse(H, regularization, max_condition_number=1e8):
+    # (H^H H + regularization I)^-1 H^H without forming the inverse: a Cholesky
+    # solve of the Hermitian system.  Where the system is ill-conditioned, a QR
+    # decomposition of the stacked matrix [H; sqrt(regularization) I], or the
+    # minimum-norm pseudo-inverse of H without regularization (to handle singularity).
+    N_t = H.shape[-1]
+
     # Hermitian transpose of each subcarrier's H: (N_sc, N_t, N_r)
-    H_hermitian = np.conjugate(np.transpose(H, (0, 2, 1)))
+    H_hermitian = np.conjugate(np.swapaxes(H, -1, -2))
 
-    # (H^H * H) for all subcarriers: (N_sc, N_t, N_t)
-    H_herm_H = np.matmul(H_hermitian, H)
+    # (H^H * H + regularization * I) for all subcarriers: (N_sc, N_t, N_t)
+    gram = np.matmul(H_hermitian, H) + regularization * np.eye(N_t)
 
-    # Add noise power to diagonal (1/SNR * I)
-    identity = np.eye(N_t)[None, :, :]
-    H_mmse_term = H_herm_H + (1 / snr_linear) * identity  # Shape (N_sc, N_t, N_t)
+    try:
+        L = np.linalg.cholesky(gram)
+    except np.linalg.LinAlgError:
+        return _ill_conditioned_pseudo_inverse(H, regularization)
 
-    # Compute the inverse of (H^H * H + (1/SNR) * I) for all subcarriers
-    H_mmse_inv = np.linalg.inv(H_mmse_term)  # Shape: (N_sc, N_t, N_t)
+    # Ill-conditioned matrices are solved again below.
+    with np.errstate(divide='ignore', invalid='ignore'):
+        W = _solve_triangular(L, H_hermitian, lower=True)
+        W = _solve_triangular(np.conjugate(np.swapaxes(L, -1, -2)), W, lower=False)
+
+    # The condition number of the Gram matrix is about the squared ratio of the
+    # largest to the smallest diagonal of L (NaN for a singular Gram matrix).
+    diagonal = np.abs(np.diagonal(L, axis1=-2, axis2=-1))
+    ill_conditioned = ~(np.max(diagonal, axis=-1) ** 2 <= max_condition_number * np.min(diagonal, axis=-1) ** 2)
+    if np.any(ill_conditioned):
+        W[ill_conditioned] = _ill_conditioned_pseudo_inverse(H[ill_conditioned], regularization)
+
+    return W
+
+
+def _ill_conditioned_pseudo_inverse(H, regularization):
+    if regularization == 0:
+        return np.linalg.pinv(H)
+
+    return _regularized_pseudo_inverse_QR(H, regularization)
 
-    # MMSE equalization matrix: (H^H * H + (1/SNR) * I)^-1 * H^H
-    W_mmse = np.matmul(H_mmse_inv, H_hermitian)  # Shape (N_sc, N_t, N_r)
 
-    return W_mmse
+def _regularized_pseudo_inverse_QR(H, regularization):
+    # With [H; sqrt(regularization) I] = Q R, the equalizer is R^-1 Q_H^H, where Q_H are the first N_r rows of Q.
+    N_r, N_t = H.shape[-2:]
 
+    stacked = np.concatenate([H, np.broadcast_to(np.sqrt(regularization) * np.eye(N_t), H.shape[:-2] + (N_t, N_t))], axis=-2)
+    Q, R = np.linalg.qr(stacked)
 
-def _estimate_channel_least_squares(X, Y):
-    global N_sc
+    return _solve_triangular(R, np.conjugate(np.swapaxes(Q[..., :N_r, :], -1, -2)), lower=False)
 
-    # This is least square (LS) estimation
-    H_estimated = Y@np.conjugate(np.transpose(X))
 
-    # Repeat it across all N_sc
-    H_estimated_full = np.repeat(H_estimated[np.newaxis, :, :], N_sc, axis=0)  # Repeat for all subcarriers
+def _solve_triangular(T, B, lower):
+    # Solves T X = B for a batch of nonsingular triangular matrices T by substitution, one row at a time.
+    n = T.shape[-1]
+    X = np.zeros(np.broadcast_shapes(T.shape[:-2], B.shape[:-2]) + B.shape[-2:], dtype=np.result_type(T, B))
+
+    rows = range(n) if lower else reversed(range(n))
+    for i in rows:
+        solved = slice(0, i) if lower else slice(i + 1, n)
+        residual = B[..., i, :] - np.matmul(T[..., i:i + 1, solved], X[..., solved, :])[..., 0, :]
+
+        X[..., i, :] = residual / T[..., i, i, None]
+
+    return X
+
+
+def _estimate_channel_least_squares(X, Y, N_sc):
+    # This is least square (LS) estimation from the pilots X (n_pilot, N_t)
+    # received as Y = X H^T + noise, with Y (n_pilot, N_r) or a batch (..., n_pilot, N_r).
+    H_estimated = np.swapaxes(np.matmul(_least_squares_filter(X), Y), -1, -2)
+
+    # The same estimate on all N_sc
+    H_estimated_full = _broadcast_subcarriers(H_estimated, N_sc)
 
     return H_estimated_full
 
 
-def _estimate_channel_linear_regression(X, Y):
-    global N_t, N_r
+def _least_squares_filter(X):
+    # The pseudo-inverse of the pilot matrix, computed once per pilot pattern: (N_t, n_pilot)
+    return _memoize(_estimation_filters, ('LS', _channel_id(X)), lambda: np.linalg.pinv(X))
 
-    # This is only for real-valued data and one subcarrier.
-    H_estimated = np.array([])
 
-    for r in range(N_r):
-        y_r = Y[:, r]
-        reg = LinearRegression(n_jobs=-1, fit_intercept=True)
-        reg.fit(X, y_r)
-        rsq = reg.score(X, y_r)
-        print(f'Fitting score on antenna {r}: {rsq:.2f}')
-        coeff_r = reg.coef_
+_estimation_filters = {}
 
-        if H_estimated.shape[0] == 0:
-            H_estimated = coeff_r
-        else:
-            H_estimated = np.c_[H_estimated, coeff_r]
 
-    # Repeat it across all N_sc
-    H_estimated_full = np.repeat(H_estimated[np.newaxis, :, :], N_sc, axis=0)  # Repeat for all subcarriers
+def _memoize(cache, key, compute, maxsize=16):
+    # A small cache of read-only arrays (or tuples of arrays): the oldest entry is dropped when full.
+    if key in cache:
+        return cache[key]
+
+    value = compute()
+    for array in (value if isinstance(value, tuple) else (value,)):
+        array.flags.writeable = False
+
+    if len(cache) >= maxsize:
+        del cache[next(iter(cache))]
+    cache[key] = value
+
+    return value
+
+
+def _estimate_channel_linear_regression(X, Y, N_sc=None, fit_intercept=True):
+    # Regression of the received Y (..., n_obs, N_r) on the transmitted X (n_obs, N_t)
+    # for all the receive antennas at once: Y = X H^T + intercept + noise.
+    # X may also hold separate regressors per subcarrier (N_sc, n_obs, N_t).  Real or complex.
+    if fit_intercept:
+        X = X - np.mean(X, axis=-2, keepdims=True)
+        Y = Y - np.mean(Y, axis=-2, keepdims=True)
+
+    # The minimum-norm least squares solution, also for a rank-deficient X.
+    H_estimated = np.swapaxes(np.matmul(np.linalg.pinv(X), Y), -1, -2)
+
+    if X.ndim > 2:
+        return H_estimated
+
+    # The same estimate on all N_sc
+    H_estimated_full = _broadcast_subcarriers(H_estimated, N_sc)
 
     return H_estimated_full
 
 
-def _estimate_channel_LMMSE(X, Y, snr_dB):
-    snr_linear = _linear(snr_dB)
+def _estimate_channel_LMMSE(X, Y, snr_dB, N_sc, profile, Df, min_power_fraction=0.1):
+    # Linear MMSE estimation on every subcarrier from the pilots X (n_pilot, N_t),
+    # where pilot k is sent on subcarrier k and received as Y (..., n_pilot, N_r).
+    U_hermitian, eigenvalues, A = _wiener_filter(X, N_sc, profile, Df)
+
+    # The noise power follows from the SNR as in channel_effect, and the channel
+    # power of each transmission from the power of its received pilots.  The
+    # power is floored at a fraction of the LS power, since a zero power would
+    # shrink the estimate (and the equalizer) to zero.
+    noise_power = _average_power(X) / _linear(snr_dB)
+    pilot_power = np.mean(np.sum(np.abs(X) ** 2, axis=-1))
+    received_power = _average_power(Y)
+    channel_power = np.maximum(received_power - noise_power, min_power_fraction * received_power) / pilot_power
+
+    # (channel_power R_tt + noise I)^-1 channel_power in the eigenbasis of R_tt.
+    shrinkage = channel_power[..., None] / (channel_power[..., None] * eigenvalues + noise_power)
+
+    H_lmmse = np.einsum('stk,...kr->...srt', A, shrinkage[..., :, None] * (U_hermitian @ Y))  # Shape (..., N_sc, N_r, N_t)
+
+    # One filter for a frequency-flat channel.
+    if A.shape[0] == 1:
+        return _broadcast_subcarriers(H_lmmse[..., 0, :, :], N_sc)
+
+    return H_lmmse
+
+
+def _wiener_filter(X, N_sc, profile, Df):
+    # Computed once per pilot pattern and channel profile.  The SNR and the
+    # channel power only scale its eigenvalues.
+    key = ('LMMSE', _channel_id(X), N_sc, profile, Df)
+
+    return _memoize(_estimation_filters, key, lambda: _compute_wiener_filter(X, N_sc, profile, Df))
+
+
+def _compute_wiener_filter(X, N_sc, profile, Df):
+    # The channel of every transmit-receive antenna pair has the prior frequency
+    # correlation R of the channel profile (normalized to unit power).  With the
+    # pilot observations t of correlation R_tt = R_pp * X X^H = U diag(eigenvalues) U^H,
+    #     h(s) = C(s) (R_tt + noise I)^-1 t = A(s) diag(1 / (eigenvalues + noise)) U^H t,
+    # where C(s) = X^H * R(s, pilots) and A(s) = C(s) U.
+    n_pilot = X.shape[0]
+
+    # Rayleigh and Ricean channels are frequency-flat and need only one subcarrier.
+    flat = profile not in _cdl_profiles
+    R = np.ones((N_sc, N_sc)) if flat else _frequency_correlation(N_sc, Df, profile)
+    R_pp = R[:n_pilot, :n_pilot]
+    R_hp = R[:1 if flat else N_sc, :n_pilot]
 
-    H_ls = _estimate_channel_least_squares(X, Y)
+    eigenvalues, U = np.linalg.eigh(R_pp * (X @ np.conjugate(X.T)))
 
-    N_sc = H_ls.shape[0]  # Number of subcarriers
+    # C(s) for every subcarrier s: (N_sc, N_t, n_pilot)
+    C = np.conjugate(X.T)[None, :, :] * R_hp[:, None, :]
 
-    # Initialize the LMMSE channel estimate
-    H_lmmse = np.zeros_like(H_ls, dtype=np.complex128)
+    return np.conjugate(U.T), np.maximum(eigenvalues, 0), C @ U
 
-    # Iterate over each subcarrier
-    for sc in range(N_sc):
-        # Compute the Frobenius norm squared for the current subcarrier's channel matrix (N_r * N_t)
-        # which corresponds tr RHH corresponds to.
-        frobenius_norm_squared = np.linalg.norm(H_ls[sc], 'fro') ** 2
 
-        # Compute the LMMSE factor for this subcarrier
-        lmmse_factor = frobenius_norm_squared / (frobenius_norm_squared + (1 / snr_linear))
+@lru_cache(maxsize=32)
+def _frequency_correlation(N_sc, Df, profile):
+    # Correlation of the CDL channel between subcarriers from its power-delay profile:
+    # R[s, s'] = sum_l p_l exp(-2j pi (s - s') Df tau_l) / sum_l p_l
+    _, powers_dB = _cdl_profiles[profile]
+    powers_linear = 10 ** (np.array(powers_dB) / 10)
+    powers_linear /= powers_linear.sum()
+
+    phase_shift = _cdl_phase_shift(N_sc, Df, profile)  # shape: (taps, N_sc)
 
-        # Apply the LMMSE factor to the least squares estimate for this subcarrier
-        H_lmmse[sc] = lmmse_factor * H_ls[sc]
+    R = (powers_linear[:, None] * phase_shift).T @ np.conjugate(phase_shift)
+    R.flags.writeable = False
 
-    return H_lmmse, H_ls
+    return R
 
 
-def estimate_channel(X, Y, snr_dB, algorithm):
-    H_lmmse, H_ls = _estimate_channel_LMMSE(X, Y, snr_dB)
+def estimate_channel(X, Y, snr_dB, algorithm, N_sc, config=None):
+    # Only the requested estimator is computed.
+    config = SimulationConfig() if config is None else config
 
     if algorithm == 'LS':
-        return H_ls
+        return _estimate_channel_least_squares(X, Y, N_sc)
 
     if algorithm == 'LMMSE':
-        return H_lmmse
+        return _estimate_channel_LMMSE(X, Y, snr_dB, N_sc, profile=config.channel_type, Df=config.Df)
+
+    if algorithm == 'regression':
+        # The intercept needs one pilot more than the transmit antennas.
+        n_pilot, N_t = X.shape
+        return _estimate_channel_linear_regression(X, Y, N_sc, fit_intercept=(n_pilot > N_t))
 
     return None
 
@@ -525,8 +721,9 @@ def quantize(X, b, max_iteration=200):
         return np.sign(X_re) + 1j * np.sign(X_im)
 
     # Very slow
-    Xb_re = np.apply_along_axis(_lloyd_max_quantization, 0, X_re, b, max_iteration)
-    Xb_im = np.apply_along_axis(_lloyd_max_quantization, 0, X_im, b, max_iteration)
+    # Quantize along the subcarriers (axis -2) of each antenna and transmission.
+    Xb_re = np.apply_along_axis(_lloyd_max_quantization, -2, X_re, b, max_iteration)
+    Xb_im = np.apply_along_axis(_lloyd_max_quantization, -2, X_im, b, max_iteration)
 
     return Xb_re + 1j * Xb_im
 
@@ -562,121 +759,267 @@ def _lloyd_max_quantization(x, b, max_iteration):
     return best_x_hat_q
 
 
-def create_channel(N_sc, N_r, N_t, shadow_fading_margin_dB=8, channel='rayleigh'):
-    global np_random
-    global f_c
+def create_channel(N_sc, N_r, N_t, shadow_fading_margin_dB=8, channel='rayleigh', config=None):
+    # One channel realization with dimensions (N_sc, N_r, N_t), as a writable array.
+    H = create_channel_batch(1, N_sc, N_r, N_t, shadow_fading_margin_dB=shadow_fading_margin_dB,
+                             channel=channel, config=config)
+    if H is None:
+        return None
+
+    return H[0]
+
+
+def create_channel_batch(batch_size, N_sc, N_r, N_t, shadow_fading_margin_dB=8, channel='rayleigh',
+                         dtype=np.complex128, config=None):
+    # batch_size independent channel realizations drawn at once
+    # with dimensions (batch_size, N_sc, N_r, N_t), as a writable array.
+    H = _create_channel_batch(batch_size, N_sc, N_r, N_t, shadow_fading_margin_dB=shadow_fading_margin_dB,
+                              channel=channel, dtype=dtype, config=config)
+    if H is None:
+        return None
 
-    G = compute_large_scale_fading(d=1, f_c=f_c)
+    return H if H.flags.writeable else H.copy()
 
+
+def _create_channel_batch(batch_size, N_sc, N_r, N_t, shadow_fading_margin_dB=8, channel='rayleigh',
+                          dtype=np.complex128, config=None):
+    # As create_channel_batch, but frequency-flat channels (rayleigh and ricean)
+    # are returned as read-only views with a zero stride on the subcarrier axis.
+    config = SimulationConfig() if config is None else config
+
+    G = compute_large_scale_fading(d=1, f_c=config.f_c)
+
+    H = None
     if channel == 'ricean':
-        return _create_ricean_channel(G, N_sc, N_r, N_t, K_factor=4, sigma_dB=shadow_fading_margin_dB)
+        H = _create_ricean_channel(G, N_sc, N_r, N_t, K_factor=4, sigma_dB=shadow_fading_margin_dB,
+                                   random_state=config.np_random, batch_size=batch_size)
 
     if channel == 'rayleigh':
-        return _create_ricean_channel(G, N_sc, N_r, N_t, K_factor=0, sigma_dB=shadow_fading_margin_dB)
+        H = _create_ricean_channel(G, N_sc, N_r, N_t, K_factor=0, sigma_dB=shadow_fading_margin_dB,
+                                   random_state=config.np_random, batch_size=batch_size)
 
-    if channel == 'CDL-C':
-        return _generate_cdl_c_channel(G, N_sc, N_r, N_t, sigma_dB=shadow_fading_margin_dB)
+    if channel in _cdl_profiles:
+        H = _generate_cdl_channel(G, N_sc, N_r, N_t, config.Df, sigma_dB=shadow_fading_margin_dB, profile=channel,
+                                  random_state=config.np_random, batch_size=batch_size)
 
-    if channel == 'CDL-E':
-        return _generate_cdl_e_channel(G, N_sc, N_r, N_t, sigma_dB=shadow_fading_margin_dB)
+    if H is None:
+        return None
 
+    # Optionally use single precision (complex64) to halve the memory.
+    if H.strides[-3] == 0:
+        return _broadcast_subcarriers(H[..., 0, :, :].astype(dtype, copy=False), N_sc)
 
-def _create_ricean_channel(G, N_sc, N_r, N_t, K_factor, sigma_dB):
-    global np_random
+    return H.astype(dtype, copy=False)
 
-    G_fading = _dB(G) - np_random.normal(loc=0, scale=np.sqrt(sigma_dB), size=(N_r, N_t))
-    G_fading = np.array([_linear(g) for g in G_fading])
 
-    mu = np.sqrt(K_factor / (1 + K_factor))
+def _create_ricean_channel(G, N_sc, N_r, N_t, K_factor, sigma_dB, random_state, batch_size=1):
+    G_fading = _dB(G) - random_state.normal(loc=0, scale=np.sqrt(sigma_dB), size=(batch_size, N_r, N_t))
+    G_fading = _linear(G_fading)
+
+    fading = _draw_ricean_fading((batch_size, N_r, N_t), K_factor, random_state)
+
+    return _ricean_channel_from_fading(fading, G_fading, K_factor, N_sc)
+
+
+def _draw_ricean_fading(size, K_factor, random_state):
+    # The scattered (zero mean) part of the small-scale fading.
     sigma = np.sqrt(1 / (1 + K_factor))
 
-    H = np_random.normal(loc=mu, scale=sigma, size=(N_r, N_t)) + \
-        1j * np_random.normal(loc=mu, scale=sigma, size=(N_r, N_t))
+    return random_state.normal(loc=0, scale=sigma, size=size) + \
+        1j * random_state.normal(loc=0, scale=sigma, size=size)
+
+
+def _ricean_channel_from_fading(fading, G_fading, K_factor, N_sc, trace=None, out=None):
+    # Add the line of sight part to the scattered part.
+    mu = np.sqrt(K_factor / (1 + K_factor))
+    H = (mu + 1j * mu) + fading
 
     # Normalize channel to unity gain and add large scale gain
-    # So the channel gain (tr(H)) is G.
-    H /= np.trace(H)
+    # So the channel gain (tr(H)) is G.  A given trace keeps the normalization fixed.
+    trace = np.trace(H, axis1=-2, axis2=-1) if trace is None else trace
+    H /= trace[..., None, None]
     H *= np.sqrt(G_fading)  # element multiplication.
 
-    H_full = np.repeat(H[np.newaxis, :, :], N_sc, axis=0)  # Repeat for all subcarriers
+    # The channel is frequency-flat: one matrix viewed on all the subcarriers.
+    if out is None:
+        return _broadcast_subcarriers(H, N_sc)
+
+    out[...] = H[..., np.newaxis, :, :]
+    return out
+
+
+# 3GPP 38.900 CDL profiles: tap delays (in microseconds) and tap powers (in dB).
+# CDL-A, CDL-B, and CDL-D are the normalized delays of 38.901 Table 7.7.1
+# scaled to a delay spread of 1 microsecond.
+_cdl_profiles = {
+    'CDL-A': ([0, 0.3819, 0.4025, 0.5868, 0.4610, 0.5375, 0.6708, 0.5750, 0.7618, 1.5375, 1.8978, 2.2242,
+               2.1718, 2.4942, 2.5119, 3.0582, 4.0810, 4.4579, 4.5695, 4.7966, 5.0066, 5.3043, 9.6586],
+              [-13.4, 0, -2.2, -4.0, -6.0, -8.2, -9.9, -10.5, -7.5, -15.9, -6.6, -16.7,
+               -12.4, -15.2, -10.8, -11.3, -12.7, -16.2, -18.3, -18.9, -16.6, -19.9, -29.7]),
+    'CDL-B': ([0, 0.1072, 0.2155, 0.2095, 0.2870, 0.2986, 0.3752, 0.5055, 0.3681, 0.3697, 0.5700, 0.5283,
+               1.1021, 1.2756, 1.5474, 1.7842, 2.0169, 2.8294, 3.0219, 3.6187, 4.1067, 4.2790, 4.7834],
+              [0, -2.2, -4.0, -3.2, -9.8, -1.2, -3.4, -5.2, -7.6, -3.0, -8.9, -9.0,
+               -4.8, -5.7, -7.5, -1.9, -7.6, -12.2, -9.8, -11.4, -14.9, -9.2, -11.3]),
+    'CDL-C': ([0, 0.209, 0.423, 0.658, 1.18, 1.44, 1.71],
+              [-0.2, -13.5, -15.4, -18.1, -20.0, -22.1, -25.2]),
+    'CDL-D': ([0, 0, 0.035, 0.612, 1.363, 1.405, 1.804, 2.596, 1.775, 4.042, 7.937, 9.424, 9.708, 12.525],
+              [-0.2, -13.5, -18.8, -21.0, -22.8, -17.9, -20.1, -21.9, -22.9, -27.8, -23.6, -24.8, -30.0, -27.7]),
+    'CDL-E': ([0, 0.264, 0.366, 0.714, 1.53, 1.91, 3.52, 4.20, 5.35],
+              [-0.03, -4.93, -8.03, -10.77, -15.86, -18.63, -21.11, -22.50, -25.63])
+}
+
+
+def _generate_cdl_channel(G, N_sc, N_r, N_t, Df, sigma_dB, profile, random_state, batch_size=1):
+    # Generates 3GPP 38.900 CDL channels with dimensions (batch_size, N_sc, N_r, N_t).
+    _, powers_dB = _cdl_profiles[profile]
+
+    # Convert dB to linear scale for power, normalized to unit total power
+    # so that all the profiles have the same average channel gain.
+    powers_linear = 10 ** (np.array(powers_dB) / 10)
+    powers_linear /= powers_linear.sum()
+    num_taps = len(powers_dB)
 
-    return H_full
+    # Apply shadow fading (log-normal) to the large-scale fading
+    shadow_fading = 10 ** (random_state.normal(0, sigma_dB, size=(batch_size, N_r, N_t)) / 10)
 
+    # Tap amplitudes from tap power, large-scale fading, and shadow fading: (batch, taps, N_r, N_t)
+    tap_gains = np.sqrt(powers_linear[None, :, None, None] * G * shadow_fading[:, None, :, :])
 
-def _generate_cdl_c_channel(G, N_sc, N_r, N_t, sigma_dB):
-    global np_random
+    # Complex Gaussian fading of all taps and antenna pairs in one draw
+    fading = _draw_cdl_fading((batch_size, num_taps, N_r, N_t), random_state)
 
-    # Generates a 3GPP 38.900 CDL-C channel with dimensions (N_sc, N_r, N_t).
-    delay_taps = [0, 0.209, 0.423, 0.658, 1.18, 1.44, 1.71]  # in microseconds
-    powers_dB = [-0.2, -13.5, -15.4, -18.1, -20.0, -22.1, -25.2]  # tap power in dBm
+    return _cdl_channel_from_fading(fading, tap_gains, N_sc, Df, profile)
 
-    # Convert dB to linear scale for power
-    powers_linear = 10 ** (np.array(powers_dB) / 10)
-    num_taps = len(powers_dB)
 
-    # Initialize the channel matrix (complex random Gaussian per subcarrier, tap, and antenna pair)
-    H = np.zeros((N_sc, N_r, N_t), dtype=np.complex128)
+def _draw_cdl_fading(size, random_state):
+    return (random_state.randn(*size) + 1j * random_state.randn(*size)) / np.sqrt(2)
 
-    # Apply shadow fading (log-normal) to the large-scale fading
-    shadow_fading = 10 ** (np_random.normal(0, sigma_dB, size=(N_r, N_t)) / 10)
 
-    # Frequency range for the subcarriers
-    subcarrier_frequencies = np.arange(N_sc) / N_sc  # normalized subcarrier indices
+def _cdl_channel_from_fading(fading, tap_gains, N_sc, Df, profile, out=None):
+    # Apply the phase shift of each tap across subcarriers and sum the taps.
+    phase_shift = _cdl_phase_shift(N_sc, Df, profile)  # shape: (taps, N_sc)
 
-    # Generate channel response for each tap and apply delay phase shifts
-    for tap in range(num_taps):
-        # Delay in seconds
-        delay = delay_taps[tap] * 1e-6  # convert from microseconds to seconds
+    if out is None:
+        return np.einsum('ls,...lrt->...srt', phase_shift, tap_gains * fading, order='C')  # (..., N_sc, N_r, N_t)
 
-        # Apply the phase shift for each subcarrier based on the delay
-        phase_shift = np.exp(-2j * np.pi * subcarrier_frequencies * delay)  # shape: (N_sc,)
+    return np.einsum('ls,...lrt->...srt', phase_shift, tap_gains * fading, out=out)
 
-        # Complex Gaussian fading for each tap, scaled by tap power, large-scale fading, and shadow fading
-        H_tap = np.sqrt(powers_linear[tap] * G * shadow_fading[:, :, None]) * \
-                (np_random.randn(N_r, N_t, N_sc) + 1j * np_random.randn(N_r, N_t, N_sc)) / np.sqrt(2)
 
-        # Apply phase shift across subcarriers
-        H += (H_tap * phase_shift).transpose(2, 0, 1)  # Adjust dimensions (N_sc, N_r, N_t)
+@lru_cache(maxsize=32)
+def _cdl_phase_shift(N_sc, Df, profile):
+    delay_taps, _ = _cdl_profiles[profile]
 
-    return H
+    # Delay in seconds
+    delays = np.array(delay_taps) * 1e-6  # convert from microseconds to seconds
 
+    # Frequency of each subcarrier
+    subcarrier_frequencies = np.arange(N_sc) * Df
 
-def _generate_cdl_e_channel(G, N_sc, N_r, N_t, sigma_dB):
-    global np_random
+    # The phase shift for each tap and subcarrier based on the delay
+    phase_shift = np.exp(-2j * np.pi * delays[:, None] * subcarrier_frequencies[None, :])
+    phase_shift.flags.writeable = False
 
-    # Generates a 3GPP 38.900 CDL-E channel with dimensions (N_sc, N_r, N_t).
-    delay_taps = [0, 0.264, 0.366, 0.714, 1.53, 1.91, 3.52, 4.20, 5.35]  # in microseconds
-    powers_dB = [-0.03, -4.93, -8.03, -10.77, -15.86, -18.63, -21.11, -22.50, -25.63]  # tap power in dBm
+    return phase_shift
 
-    # Convert dB to linear scale for power
-    powers_linear = 10 ** (np.array(powers_dB) / 10)
-    num_taps = len(powers_dB)
 
-    # Initialize the channel matrix (complex random Gaussian per subcarrier, tap, and antenna pair)
-    H = np.zeros((N_sc, N_r, N_t), dtype=np.complex128)
+class ChannelProcess:
+    '''
+        A time-correlated channel with dimensions (N_sc, N_r, N_t).
+        Large-scale and shadow fading are fixed, and the small-scale fading
+        evolves as a first-order Gauss-Markov process
+            h[n + 1] = rho h[n] + sqrt(1 - rho^2) w[n]
+        with the Jakes correlation rho = J0(2 pi f_D T) for a Doppler f_D
+        and a time step T (one OFDM symbol by default).
+    '''
+    def __init__(self, N_sc, N_r, N_t, doppler_Hz, time_step=None,
+                 shadow_fading_margin_dB=8, channel='rayleigh', config=None):
+        config = SimulationConfig() if config is None else config
 
-    # Apply shadow fading (log-normal) to the large-scale fading
-    shadow_fading = 10 ** (np_random.normal(0, sigma_dB, size=(N_r, N_t)) / 10)
+        if channel not in ['rayleigh', 'ricean'] and channel not in _cdl_profiles:
+            raise ValueError(f'Unsupported channel type {channel}.')
 
-    # Frequency range for the subcarriers
-    subcarrier_frequencies = np.arange(N_sc) / N_sc  # normalized subcarrier indices
+        self.channel = channel
+        self.N_sc = N_sc
+        self.Df = config.Df
+        self.np_random = config.np_random
+        self.time_step = 1. / self.Df if time_step is None else time_step
+        self.rho = j0(2 * np.pi * doppler_Hz * self.time_step)
 
-    # Generate channel response for each tap and apply delay phase shifts
-    for tap in range(num_taps):
-        # Delay in seconds
-        delay = delay_taps[tap] * 1e-6  # convert from microseconds to seconds
+        G = compute_large_scale_fading(d=1, f_c=config.f_c)
+        sigma_dB = shadow_fading_margin_dB
 
-        # Apply the phase shift for each subcarrier based on the delay
-        phase_shift = np.exp(-2j * np.pi * subcarrier_frequencies * delay)
+        # Same draws as the static generators.
+        if channel in ['rayleigh', 'ricean']:
+            self.K_factor = 4 if channel == 'ricean' else 0
+            self._G_fading = _linear(_dB(G) - self.np_random.normal(loc=0, scale=np.sqrt(sigma_dB), size=(N_r, N_t)))
+            self._fading = _draw_ricean_fading((N_r, N_t), self.K_factor, self.np_random)
 
-        # Complex Gaussian fading for each tap, scaled by tap power, large-scale fading, and shadow fading
-        H_tap = np.sqrt(powers_linear[tap] * G * shadow_fading[:, :, None]) * \
-                (np_random.randn(N_r, N_t, N_sc) + 1j * np_random.randn(N_r, N_t, N_sc)) / np.sqrt(2)
+            # The normalization of the initial channel is kept for all the steps,
+            # so that H stays linear in the fading and follows its correlation.
+            mu = np.sqrt(self.K_factor / (1 + self.K_factor))
+            self._trace = np.trace((mu + 1j * mu) + self._fading)
+        else:
+            _, powers_dB = _cdl_profiles[channel]
+            powers_linear = 10 ** (np.array(powers_dB) / 10)
+            powers_linear /= powers_linear.sum()
+            shadow_fading = 10 ** (self.np_random.normal(0, sigma_dB, size=(N_r, N_t)) / 10)
+            self._tap_gains = np.sqrt(powers_linear[:, None, None] * G * shadow_fading[None, :, :])
+            self._fading = _draw_cdl_fading((len(powers_dB), N_r, N_t), self.np_random)
+
+        self.H = np.empty((N_sc, N_r, N_t), dtype=np.complex128)
+        self._update_channel()
+
+    def step(self):
+        # Advance the fading by one time step in place.
+        if self.channel in ['rayleigh', 'ricean']:
+            innovation = _draw_ricean_fading(self._fading.shape, self.K_factor, self.np_random)
+        else:
+            innovation = _draw_cdl_fading(self._fading.shape, self.np_random)
 
-        # Apply phase shift across subcarriers
-        H += (H_tap * phase_shift).transpose(2, 0, 1)  # Adjust dimensions (N_sc, N_r, N_t)
+        self._fading *= self.rho
+        self._fading += np.sqrt(1 - self.rho ** 2) * innovation
 
-    return H
+        return self._update_channel()
+
+    def _update_channel(self):
+        # Writes into the same channel array every time.
+        if self.channel in ['rayleigh', 'ricean']:
+            _ricean_channel_from_fading(self._fading, self._G_fading, self.K_factor, self.N_sc,
+                                        trace=np.asarray(self._trace), out=self.H)
+        else:
+            _cdl_channel_from_fading(self._fading, self._tap_gains, self.N_sc, self.Df, self.channel, out=self.H)
+
+        return self.H
+
+
+class CoherenceBlockCache:
+    '''
+        Quantities that depend only on the channel (estimate, compression,
+        effective channel, equalizer) for one channel realization.  They are
+        computed once and reused by every transmission in the coherence block,
+        and the cache is cleared when the channel changes.
+    '''
+    def __init__(self):
+        self.channel_id = None
+        self._values = {}
+
+    def get(self, H, key, compute):
+        # compute() is only called on a miss.
+        channel_id = _channel_id(H)
+        if channel_id != self.channel_id:
+            self.channel_id = channel_id
+            self._values = {}
+
+        if key not in self._values:
+            self._values[key] = compute()
+
+        return self._values[key]
+
+
+def _channel_id(H):
+    # Identifies a channel by its content, since ChannelProcess updates H in place.
+    digest = hashlib.blake2b(np.ascontiguousarray(H).view(np.uint8), digest_size=8)
+    return H.shape, digest.hexdigest()
 
 
 def compute_large_scale_fading(d, f_c, D_t_dB=18, D_r_dB=2, pl_exp=1.07):
@@ -688,21 +1031,25 @@ def compute_large_scale_fading(d, f_c, D_t_dB=18, D_r_dB=2, pl_exp=1.07):
     return G
 
 
-def compress_channel(H, compression_ratio, quantization_b, epochs=200, batch_size=16, learning_rate=1e-4, plotting=False):
+def compress_channel(H, compression_ratio, quantization_b, epochs=200, batch_size=16, learning_rate=1e-4, plotting=False,
+                     config=None):
+    config = SimulationConfig() if config is None else config
+
     if compression_ratio >= 1 or compression_ratio < 0:
         raise ValueError("Compression choose compression ratio in [0,1).")
 
     if compression_ratio == 0:
         return H, H, np.nan
 
-    global np_random, seed
     global output_path
 
-    N_sc, N_r, N_t = H.shape
+    # H is (N_sc, N_r, N_t) or a batch of channels (..., N_sc, N_r, N_t).
+    batch_shape = H.shape[:-3]
+    N_sc, N_r, N_t = H.shape[-3:]
 
     # First step, convert the real and imag parts of H into a vector of the size 2N_t
-    H = np.c_[np.real(H), np.imag(H)]
-    H = H.reshape((1, N_sc, N_r, 2*N_t))
+    H = np.concatenate([np.real(H), np.imag(H)], axis=-1)
+    H = H.reshape((-1, N_sc, N_r, 2*N_t))
 
     # This dimension is the dimension of the compressed channel
     latent_dim = 2 * N_r * N_t * int(np.ceil((1 - compression_ratio) * N_sc))
@@ -713,7 +1060,7 @@ def compress_channel(H, compression_ratio, quantization_b, epochs=200, batch_siz
     X_test = H
 
     autoencoder = Autoencoder(latent_dim,
-                              shape=H.shape[1:], seed=seed)
+                              shape=H.shape[1:], seed=config.seed)
     autoencoder.compile(optimizer=keras.optimizers.Adam(learning_rate=learning_rate), loss=losses.MeanSquaredError())
 
     autoencoder.train_on_batch(X_train, X_train)
@@ -752,22 +1099,23 @@ def compress_channel(H, compression_ratio, quantization_b, epochs=200, batch_siz
     # Decoder tries to reconstruct the true signal
     H_reconstructed = autoencoder.decoder.predict(H_compressed)
 
-    H = H.reshape((-1, N_r, 2*N_t))
-    H_compressed = H_compressed.reshape((-1, N_r, 2*N_t))
-    H_reconstructed = H_reconstructed.reshape((-1, N_r, 2*N_t))
+    H = H.reshape(batch_shape + (-1, N_r, 2*N_t))
+    H_compressed = H_compressed.reshape(batch_shape + (-1, N_r, 2*N_t))
+    H_reconstructed = H_reconstructed.reshape(batch_shape + (-1, N_r, 2*N_t))
 
     # Now reassemble the channel, eliminating the dimension (this is correct)
-    H = H[:, :, :N_t] + 1j * H[:, :, N_t:]
-    H_compressed = H_compressed[:, :, :N_t] + 1j * H_compressed[:, :, N_t:]
-    H_reconstructed = H_reconstructed[:, :, :N_t] + 1j * H_reconstructed[:, :, N_t:]
+    H = H[..., :N_t] + 1j * H[..., N_t:]
+    H_compressed = H_compressed[..., :N_t] + 1j * H_compressed[..., N_t:]
+    H_reconstructed = H_reconstructed[..., :N_t] + 1j * H_reconstructed[..., N_t:]
 
     error = _mse(H, H_reconstructed)
 
     if plotting:
+        # Plot the first channel of a batch.
         vmin = np.abs(H).min()
         vmax = np.abs(H).max()
-        plot_channel(H_compressed, vmin=vmin, vmax=vmax, filename=f'compressed_{compression_ratio}')
-        plot_channel(H_reconstructed, vmin=vmin, vmax=vmax, filename=f'reconstr_{compression_ratio}')
+        plot_channel(H_compressed.reshape((-1,) + H_compressed.shape[-3:])[0], vmin=vmin, vmax=vmax, filename=f'compressed_{compression_ratio}')
+        plot_channel(H_reconstructed.reshape((-1,) + H_reconstructed.shape[-3:])[0], vmin=vmin, vmax=vmax, filename=f'reconstr_{compression_ratio}')
 
     return H_compressed, H_reconstructed, error
 
@@ -820,8 +1168,8 @@ def _vec(H):
     return H.flatten(order='F')
 
 
-def _mse(H_true, H_estimated):
-    return np.mean(np.abs(H_true - H_estimated) ** 2)
+def _mse(H_true, H_estimated, axis=None):
+    return np.mean(np.abs(H_true - H_estimated) ** 2, axis=axis)
 
 
 def _dB(X):
@@ -832,83 +1180,124 @@ def _linear(X):
     return 10 ** (X / 10.)
 
 
-def detect_symbols(z, alphabet, algorithm):
-    global np_random
+def detect_symbols(z, alphabet, algorithm, config=None):
+    # The learned detectors are seeded from config.
+    config = SimulationConfig() if config is None else config
 
     if algorithm == 'kmeans':
-        return _detect_symbols_kmeans(z, alphabet)
+        return _detect_symbols_kmeans(z, alphabet, seed=config.seed)
 
     if algorithm == 'ML':
         return _detect_symbols_ML(z, alphabet)
     
     # Supervised learning detections
-    y = alphabet['m'].values
-    X = np.c_[np.real(alphabet['x']), np.imag(alphabet['x'])]
+    y = alphabet.labels
+    X = np.c_[np.real(alphabet.points), np.imag(alphabet.points)]
 
     X_infer = z.flatten()
     X_infer = np.c_[np.real(X_infer), np.imag(X_infer)]
     
     if algorithm == 'ensemble':    
         _, [training_accuracy_score, test_accuracy_score], y_infer =  \
-            _detect_symbols_ensemble(X, y, X_infer)
+            _detect_symbols_ensemble(alphabet, X_infer, seed=config.seed)
                 
         # print(f'Ensemble training accuracy is {training_accuracy_score:.2f}.')
         # print(f'Ensemble test accuracy is {test_accuracy_score:.2f}.')
     
     if algorithm == 'DNN':
         _, [train_acc_score, test_acc_score], y_infer = \
-            _detect_symbols_DNN(X, y, X_infer)
+            _detect_symbols_DNN(X, y, X_infer, random_state=config.np_random)
 
         # print(f'DNN training accuracy is {train_acc_score:.2f}.')
         # print(f'DNN test accuracy is {test_acc_score:.2f}.')
 
-    df = pd.merge(pd.DataFrame(data={'m': y_infer}), alphabet, how='left', on='m')
-
     # Reverse the flatten operation
-    symbols = df['x'].values.reshape(z.shape)
-    information = df['m'].values.reshape(z.shape)
-    bits_i = df['I'].values.reshape(z.shape)
-    bits_q = df['Q'].values.reshape(z.shape)
-    
-    return information, symbols, [bits_i, bits_q]
+    return _symbols_from_labels(y_infer, alphabet, z.shape)
 
 
-def _detect_symbols_kmeans(x_sym_hat, alphabet):
-    global np_random
+def detect_symbols_batch(z_batch, alphabet, algorithm, config=None):
+    # Detect the equalized symbols of many transmissions (or SNR points)
+    # in one call to the detector, e.g., a single DNN predict.
+    # z_batch is a list of equalized symbol arrays.
+    sizes = [z.size for z in z_batch]
+    z_all = np.concatenate([z.flatten() for z in z_batch])
+
+    information, symbols, [bits_i, bits_q] = detect_symbols(z_all, alphabet, algorithm, config=config)
 
-    x_sym_hat_flat = x_sym_hat.flatten()
+    # Split back into the individual transmissions.
+    results = []
+    offsets = np.cumsum([0] + sizes)
+    for z, start, end in zip(z_batch, offsets[:-1], offsets[1:]):
+        results.append((information[start:end].reshape(z.shape),
+                        symbols[start:end].reshape(z.shape),
+                        [bits_i[start:end].reshape(z.shape + (-1,)),
+                         bits_q[start:end].reshape(z.shape + (-1,))]))
 
-    X = np.real(x_sym_hat_flat)
-    X = np.c_[X, np.imag(x_sym_hat_flat)]
-    X = X.astype('float32')
+    return results
 
-    centroids = np.c_[np.real(alphabet['x']), np.imag(alphabet['x'])]
+
+def _detect_symbols_kmeans(x_sym_hat, alphabet, seed):
+    # The centroids are fitted once per constellation and seed.  Every detection
+    # is then an assignment to the nearest centroid.
+    centroids = _fit_kmeans_centroids(alphabet.kind, alphabet.M, seed)
+
+    information = _nearest_point(x_sym_hat.flatten(), centroids)
+
+    return _symbols_from_labels(information, alphabet, x_sym_hat.shape)
+
+
+@lru_cache(maxsize=None)
+def _fit_kmeans_centroids(constellation, M, seed):
+    alphabet = create_constellation(constellation=constellation, M=M)
+    centroids = np.c_[np.real(alphabet.points), np.imag(alphabet.points)]
 
     # Intialize k-means centroid location deterministcally as a constellation
-    kmeans = KMeans(n_clusters=M_constellation, init=centroids, n_init=1,
-                    random_state=np_random).fit(centroids)
+    # so that cluster m is the constellation point with label m.
+    kmeans = KMeans(n_clusters=M, init=centroids, n_init=1,
+                    random_state=seed).fit(centroids)
 
-    information = kmeans.predict(X)
-    df_information = pd.DataFrame(data={'m': information})
+    centroids = kmeans.cluster_centers_[:, 0] + 1j * kmeans.cluster_centers_[:, 1]
+    centroids.flags.writeable = False
 
-    df = df_information.merge(alphabet, how='left', on='m')
-    symbols = df['x'].values.reshape(x_sym_hat.shape)
-    bits_i = df['I'].values.reshape(x_sym_hat.shape)
-    bits_q = df['Q'].values.reshape(x_sym_hat.shape)
+    return centroids
 
-    return information, symbols, [bits_i, bits_q]
 
+def _detect_symbols_ensemble(alphabet, X_test, seed, n_estimators=100, criterion='entropy',
+                             class_weight='balanced', persist=False):
+    # The classifier is trained once per constellation, seed, and hyperparameters.
+    clf, training_accuracy_score = \
+        _fit_ensemble_detector(alphabet.kind, alphabet.M, seed, n_estimators=n_estimators,
+                               criterion=criterion, class_weight=class_weight,
+                               persist=persist)
 
-def _detect_symbols_ensemble(X_train, y_train, X_test):
-    global np_random
+    y_test_pred = clf.predict(X_test)
+
+    return clf, [training_accuracy_score, np.nan], y_test_pred
+
+
+@lru_cache(maxsize=16)
+def _fit_ensemble_detector(constellation, M, seed, n_estimators, criterion, class_weight, persist):
+    # If persisting, a stored classifier is used.  Otherwise, train one.
+    filename = f'ensemble_detection_{constellation}_{M}_{seed}_{n_estimators}_{criterion}_{class_weight}.pkl'
+    if persist:
+        try:
+            with open(filename, 'rb') as f:
+                clf = pickle.load(f)
+            clf.n_jobs = _n_jobs
+            return clf, np.nan  # no training is done.
+        except Exception as e:
+            print(f'Failed to load model due to {e}.  Training from scratch.')
 
-    y_train = y_train.ravel()
+    alphabet = create_constellation(constellation=constellation, M=M)
+
+    X_train = np.c_[np.real(alphabet.points), np.imag(alphabet.points)]
+    y_train = alphabet.labels.ravel()
 
     # The classifier hyperparameters need to be tuned.
-    base_estimator = RandomForestClassifier(n_estimators=100, n_jobs=-1, 
-                                            criterion='entropy',
-                                            class_weight='balanced',
-                                            random_state=np_random)
+    base_estimator = RandomForestClassifier(n_estimators=n_estimators, n_jobs=_n_jobs,
+                                            criterion=criterion,
+                                            class_weight=class_weight,
+                                            random_state=seed)
 
     # hyperparameters = {'criterion': ['entropy', 'gini'],
     #                     'min_impurity_decrease': [0.1, 0.2],
@@ -925,45 +1314,115 @@ def _detect_symbols_ensemble(X_train, y_train, X_test):
     clf = base_estimator  # No cross validation is done.
     clf.fit(X_train, y_train)
 
-    y_test_pred = clf.predict(X_test)
     training_accuracy_score = clf.score(X_train, y_train)
-    
-    return clf, [training_accuracy_score, np.nan], y_test_pred
 
+    if persist:
+        with open(filename, 'wb') as f:
+            pickle.dump(clf, f)
 
-def _detect_symbols_ML(symbols, alphabet):
-    # Flatten symbols for easier processing
-    symbols_flat = symbols.flatten()
+    return clf, training_accuracy_score
 
-    # Calculate distances to each constellation point
-    distances = np.abs(symbols_flat[:, None] - alphabet['x'].values[None, :]) ** 2
 
-    # Find the index of the closest constellation point
-    m_star_indices = np.argmin(distances, axis=1)
+def _detect_symbols_ML(symbols, alphabet):
+    # Square QAM is detected per axis; any other constellation
+    # by a search over the distances to each constellation point.
+    if alphabet.levels is not None:
+        m_star_indices = _slice_square_qam(symbols, alphabet)
+    else:
+        m_star_indices = _nearest_point(symbols.flatten(), alphabet.points)
 
     # Map indices to alphabet entries
-    detected_alphabet = alphabet.iloc[m_star_indices]
+    return _symbols_from_labels(m_star_indices, alphabet, symbols.shape)
+
+
+def _slice_square_qam(symbols, alphabet):
+    # The ML decision on square QAM separates into two PAM slicers:
+    # round each of I and Q to the nearest level, and clip to the outer levels.
+    levels = alphabet.levels
+    spacing = levels[1] - levels[0]
+
+    idx_I = np.rint((np.real(symbols) - levels[0]) / spacing)
+    idx_Q = np.rint((np.imag(symbols) - levels[0]) / spacing)
+
+    idx_I = np.clip(idx_I, 0, len(levels) - 1).astype(int)
+    idx_Q = np.clip(idx_Q, 0, len(levels) - 1).astype(int)
+
+    return alphabet.grid_to_label[idx_I, idx_Q].flatten()
+
+
+def _nearest_point(symbols_flat, points, chunk_size=4096):
+    # Symbols are processed in chunks so that the distance matrix
+    # never exceeds (chunk_size x M).
+    m_star_indices = np.empty(symbols_flat.shape[0], dtype=int)
+    points_power = np.abs(points) ** 2
+
+    for start in range(0, symbols_flat.shape[0], chunk_size):
+        chunk = symbols_flat[start:(start + chunk_size)]
+
+        # Calculate distances to each constellation point up to |z|^2 which
+        # is common to all points: |z - x|^2 - |z|^2 = |x|^2 - 2 Re(z x*)
+        distances = points_power[None, :] - 2 * np.real(chunk[:, None] * np.conjugate(points[None, :]))
+
+        # Find the index of the closest constellation point
+        m_star_indices[start:(start + chunk_size)] = np.argmin(distances, axis=1)
+
+    return m_star_indices
+
+
+def compute_llr(z, alphabet, noise_variance, chunk_size=4096):
+    # Soft demapper: max-log LLR of every bit, log P(b = 0 | z) / P(b = 1 | z)
+    # ~ (min_{x: b = 1} |z - x|^2 - min_{x: b = 0} |z - x|^2) / noise_variance.
+    # noise_variance is the post-equalization noise variance: a scalar or
+    # an array that broadcasts to z (e.g., per subcarrier and stream).  For an
+    # equalizer W (N_sc, N_s, N_r) and white noise of power noise_power per
+    # receive antenna, it is noise_power * np.sum(np.abs(W) ** 2, axis=-1).
+    z_flat = z.flatten()
+    noise_variance = np.broadcast_to(noise_variance, z.shape).flatten()
+
+    k = alphabet.k
+    points = alphabet.points
+    points_power = np.abs(points) ** 2
+
+    # Constellation points whose j-th bit is 1 and 0.
+    ones = [np.flatnonzero(alphabet.bits[:, j] == 1) for j in range(k)]
+    zeros = [np.flatnonzero(alphabet.bits[:, j] == 0) for j in range(k)]
 
-    # Extract relevant information
-    information = detected_alphabet['m'].values.reshape(symbols.shape)
-    detected_symbols = detected_alphabet['x'].values.reshape(symbols.shape)
-    bits_i = detected_alphabet['I'].values.reshape(symbols.shape)
-    bits_q = detected_alphabet['Q'].values.reshape(symbols.shape)
+    llr = np.empty((z_flat.shape[0], k))
 
-    return information, detected_symbols, [bits_i, bits_q]
+    # Symbols are processed in chunks so that memory stays at (chunk_size x M).
+    for start in range(0, z_flat.shape[0], chunk_size):
+        chunk = z_flat[start:(start + chunk_size)]
 
+        # |z|^2 is common to all points and cancels out in the LLR.
+        distances = points_power[None, :] - 2 * np.real(chunk[:, None] * np.conjugate(points[None, :]))
 
-def _detect_symbols_DNN(X_train, y_train, X_test, depth=6, width=8,
+        for j in range(k):
+            llr[start:(start + chunk_size), j] = distances[:, ones[j]].min(axis=1) - \
+                distances[:, zeros[j]].min(axis=1)
+
+        llr[start:(start + chunk_size), :] /= noise_variance[start:(start + chunk_size), None]
+
+    return llr.reshape(z.shape + (k,))
+
+
+def _detect_symbols_DNN(X_train, y_train, X_test, random_state, depth=6, width=8,
                         epoch_count=512, batch_size=16):
     _, nX = X_test.shape
 
+    # A model already held in memory only needs inference.
+    if 'dnn_detection.keras' in _dnn_models:
+        dnn_classifier = _dnn_models['dnn_detection.keras']
+        y_test_pred = _predict_dnn(dnn_classifier, X_test)
+
+        return dnn_classifier, [np.nan, np.nan], y_test_pred
+
     # Make more data since the constellation size is small.
     # This improves the learning significantly.
     X_train_augmented = np.empty((0, nX))
     epsilons = [1e-2, 1e-3]
     
     for perturb in epsilons:
-        X_train_i = X_train + np_random.normal(0, scale=perturb, size=X_train.shape)
+        X_train_i = X_train + random_state.normal(0, scale=perturb, size=X_train.shape)
         X_train_augmented = np.r_[X_train_augmented, X_train_i]
     
     X_train = np.r_[X_train, X_train_augmented]
@@ -1016,13 +1475,32 @@ def _train_dnn(X_train, Y_train, X_test, depth, width, epoch_count,
             y_train_pred = np.argmax(Y_pred, axis=1)
             _plot_keras_learning(history, filename='dnn_detection')
             
+    # Hold the model for the rest of the process.
+    _dnn_models['dnn_detection.keras'] = dnn_classifier
+
     # Perform inference.
+    y_test_pred = _predict_dnn(dnn_classifier, X_test)
+
+    return dnn_classifier, [training_accuracy_score, np.nan], y_test_pred
+
+
+# DNN models loaded or trained in this process, by file name.
+_dnn_models = {}
+
+
+def _predict_dnn(dnn_classifier, X_test, batch_size=8192):
+    global prefer_gpu
+
+    use_cuda = len(tf.config.list_physical_devices('GPU')) > 0 and prefer_gpu
+    device = "/gpu:0" if use_cuda else "/cpu:0"
+
+    # Large batches keep the number of inference steps low.
     with tf.device(device):
-        Y_test_pred = dnn_classifier.predict(X_test, verbose=0)
-        
+        Y_test_pred = dnn_classifier.predict(X_test, batch_size=batch_size, verbose=0)
+
     y_test_pred = np.argmax(Y_test_pred, axis=1)
-    
-    return dnn_classifier, [training_accuracy_score, np.nan], y_test_pred 
+
+    return y_test_pred
 
 
 def __loss_fn_classifier(Y_true, Y_pred):
@@ -1174,47 +1652,104 @@ def __create_lstm(input_shape, output_shape, depth, width, learning_rate):
 
 
 def bits_from_IQ(x_b_i, x_b_q):
-    assert x_b_i.shape == x_b_q.shape
-    shape = x_b_i.shape
+    # Bits per symbol are on the last axis.
+    assert x_b_i.shape[:-1] == x_b_q.shape[:-1]
 
-    bits = np.array([f"{i}{q}" for i, q in zip(np.array(x_b_i).flatten(), np.array(x_b_q).flatten())])
-    bits = np.reshape(bits, shape)
+    bits = np.concatenate([x_b_i, x_b_q], axis=-1).astype(np.uint8)
 
-    flattened = ''.join(bits.flatten())
+    # One codeword per (N_sc, N_t) transmission; leading axes are a batch.
+    flattened = bits.reshape(bits.shape[:-3] + (-1,))
 
     return bits, flattened
 
 
 def compute_bit_error_rate(a, b):
-    assert(len(a) == len(b))
+    # Bits are on the last axis.  With a leading (transmissions) axis, the
+    # bit error rate of every block is returned.
+    length = np.shape(a)[-1]
+    bit_errors, _ = count_bit_errors(a, b)
+
+    return bit_errors / length
+
+
+# Number of set bits of every byte value.
+_popcount_table = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).sum(axis=1)
+
+
+def count_bit_errors(a, b):
+    # a and b are (..., n_bits) arrays of 0/1 bits which broadcast
+    # against each other, e.g., (n_bits,) and (transmissions, n_bits).
+    assert(np.shape(a)[-1] == np.shape(b)[-1])
+
+    a = np.packbits(np.asarray(a, dtype=np.uint8), axis=-1)
+    b = np.packbits(np.asarray(b, dtype=np.uint8), axis=-1)
+
+    # XOR whole words then count the bits that differ.
+    bit_errors_per_block = _popcount_table[a ^ b].sum(axis=-1)
+    total_bit_errors = bit_errors_per_block.sum()
 
-    length = len(a)
-    bit_error = 0
-    for idx in range(length):
-        if a[idx] != b[idx]:
-            bit_error += 1
+    return bit_errors_per_block, total_bit_errors
 
-    return bit_error / length
 
+def compute_crc(x_bits, crc_generator):
+    # CRC is the remainder of the polynomial division of x(t) t^n by the
+    # generator of degree n (zero initial value, MSB first, no final XOR).
+    # Bits are on the last axis, and all leading axes are blocks.
+    x_bits = np.asarray(x_bits, dtype=np.uint8)
+    batch_shape = x_bits.shape[:-1]
+    x_bits = x_bits.reshape(-1, x_bits.shape[-1])
 
-def compute_crc(x_bits_orig, crc_generator):
-    # Introduce CRC to x
-    length_crc = len(bin(crc_generator)[2:])
+    length_crc = crc_generator.bit_length() - 1
+    table, shift = _crc_table(crc_generator)
+    width = length_crc + shift
+    mask = np.uint64((1 << width) - 1)
 
-    x_bits = x_bits_orig.zfill(length_crc)
+    # Leading zeros do not change the remainder, so pad to whole bytes on the left.
+    n_pad = -x_bits.shape[1] % 8
+    x_bytes = np.packbits(np.pad(x_bits, ((0, 0), (n_pad, 0))), axis=-1)
 
-    crc = 0
-    for position, value in enumerate(bin(crc_generator)[2:]):
-        if value == '1':
-            crc = crc ^ int(x_bits[position])
+    # One table lookup per byte for all blocks at once.
+    crc = np.zeros(x_bytes.shape[0], dtype=np.uint64)
+    for idx in range(x_bytes.shape[1]):
+        byte = ((crc >> np.uint64(width - 8)) ^ x_bytes[:, idx]) & np.uint64(0xFF)
+        crc = ((crc << np.uint64(8)) & mask) ^ table[byte]
 
-    crc = bin(crc)[2:]
-    crc = crc.zfill(length_crc)
+    crc >>= np.uint64(shift)
 
-    return crc
+    positions = np.arange(length_crc - 1, -1, -1, dtype=np.uint64)
+    crc = ((crc[:, None] >> positions) & np.uint64(1)).astype(np.uint8)
 
+    return crc.reshape(batch_shape + (length_crc,))
+
+
+@lru_cache(maxsize=None)
+def _crc_table(crc_generator):
+    # The 256-entry byte table of the generator polynomial.  Generators of
+    # degree less than 8 are aligned to the top of an 8-bit register.
+    length_crc = crc_generator.bit_length() - 1
+    shift = max(0, 8 - length_crc)
+    width = length_crc + shift
+
+    mask = (1 << width) - 1
+    top_bit = 1 << (width - 1)
+    polynomial = ((crc_generator & ((1 << length_crc) - 1)) << shift) & mask
+
+    table = np.zeros(256, dtype=np.uint64)
+    for byte in range(256):
+        crc = byte << (width - 8)
+        for _ in range(8):
+            crc = ((crc << 1) ^ polynomial) if crc & top_bit else (crc << 1)
+            crc &= mask
+        table[byte] = crc
+
+    table.flags.writeable = False
+
+    return table, shift
+
+
+def compute_precoder_combiner(H, P_TX, algorithm='SVD_Waterfilling', config=None):
+    config = SimulationConfig() if config is None else config
 
-def compute_precoder_combiner(H, P_TX, algorithm='SVD_Waterfilling'):
     N_sc, N_r, N_t = H.shape
     N_s = min(N_r, N_t)
 
@@ -1224,14 +1759,19 @@ def compute_precoder_combiner(H, P_TX, algorithm='SVD_Waterfilling'):
     if algorithm == 'identity':
         F = np.eye(N_t) #, N_s)
         Gcomb = np.eye(N_r)
-        F = np.repeat(F[np.newaxis, :, :], N_sc, axis=0)  # Repeat for all subcarriers
-        Gcomb = np.repeat(Gcomb[np.newaxis, :, :], N_sc, axis=0)  # Repeat for all subcarriers
+        F = _broadcast_subcarriers(F, N_sc)  # Same for all subcarriers
+        Gcomb = _broadcast_subcarriers(Gcomb, N_sc)  # Same for all subcarriers
         return F, Gcomb
 
+    # A frequency-flat channel has the same precoder and combiner on all subcarriers.
+    if algorithm != 'dft_beamforming' and N_sc > 1 and _is_frequency_flat(H):
+        F, Gcomb = compute_precoder_combiner(H[:1], P_TX, algorithm=algorithm, config=config)
+        return _broadcast_subcarriers(F[0], N_sc), _broadcast_subcarriers(Gcomb[0], N_sc)
+
     if algorithm == 'dft_beamforming':
         if N_r != 1:
             raise ValueError("Channel must have a single receive antenna.")
-        F = _dft_codebook(N_t)
+        F = _dft_codebook(N_t, config.f_c)
 
         # Search for the optimal beamformer
         max_sinr = -np.inf
@@ -1269,9 +1809,7 @@ def compute_precoder_combiner(H, P_TX, algorithm='SVD_Waterfilling'):
         return F, Gcomb
 
 
-def _dft_codebook(N_t, k_oversample=1):
-    global f_c
-
+def _dft_codebook(N_t, f_c, k_oversample=1):
     wavelength = speed_of_light / f_c
 
     d = wavelength / 2.  # antenna spacing
@@ -1338,17 +1876,18 @@ def _waterfilling(S, power):
     return P
 
 
-def _matrix_vector_multiplication(A, B):
-    try:
-        N_sc = A.shape[0]
+def _matrix_vector_multiplication(A, B, out=None):
+    # A[sc] @ B[sc] for all subcarriers in one call.  B (and out) may carry
+    # leading batch axes (..., N_sc, N).
+    if A.ndim == 2:
+        # Beamforming: A is (N_sc, 1), a scalar per subcarrier.
+        return np.multiply(A, B, out=out)
+
+    if out is None:
+        return np.matmul(A, B[..., np.newaxis])[..., 0]
 
-        ans = np.zeros((N_sc, A.shape[1]), dtype=np.complex128)
-        for n in range(N_sc):
-            ans[n, :] = A[n, :]@B[n]
-        return ans
-    except:
-        # This is likely due to beamforming.
-        return A@B
+    np.matmul(A, B[..., np.newaxis], out=out[..., np.newaxis])
+    return out
 
 
 def plot_performance(df, xlabel, ylabel, semilogy=True, filename=None):
@@ -1970,203 +2509,430 @@ def _print_divider(rep=125):
     print('-' * rep)
 
 
-def run_simulation(transmit_SNR_dB, constellation, M_constellation, crc_generator, N_sc, N_r, N_t):
-    global np_random
-    global P_BS
-
-    global precoder, channel_type, quantization_b, Df, max_transmissions
-    global p_interference, interference_power_dBm
-    global channel_compression_ratio
+def run_simulation(transmit_SNR_dB, constellation, M_constellation, crc_generator, N_sc, N_r, N_t, config=None):
+    # The module parameters are used unless a SimulationConfig is given.
+    config = SimulationConfig() if config is None else config
 
     start_time = time.time()
 
+    # A checkpoint holds the random state at the start of the sweep and the
+    # completed SNR points.  Resuming restores the state and skips these points.
+    # It is removed when the sweep finishes, so a later sweep is a new replica.
+    checkpoint_file = None
+    checkpoint = None
+    if config.checkpoint_path is not None:
+        fingerprint = config.fingerprint(list(transmit_SNR_dB), constellation, M_constellation,
+                                         crc_generator, N_sc, N_r, N_t)
+        checkpoint_file = os.path.join(config.checkpoint_path, f'sweep_{fingerprint}.pkl')
+        checkpoint = _load_checkpoint(checkpoint_file)
+
+        # A complete checkpoint is left over from a finished sweep and not resumed.
+        if checkpoint is not None and len(checkpoint['outcomes']) == len(transmit_SNR_dB):
+            checkpoint = None
+
+    if checkpoint is None:
+        checkpoint = {'random_state': config.np_random.get_state(), 'outcomes': {}}
+    else:
+        print(f'Resuming from {checkpoint_file} with {len(checkpoint["outcomes"])} SNR point(s) completed.')
+        config.np_random.set_state(checkpoint['random_state'])
+
     # This is the power of one OFDM symbol (across all subcarriers)
-    P_TX = P_BS / N_t
+    P_TX = config.P_BS / N_t
 
     # Number of streams.
-    N_s = min(N_r, N_t) if precoder != 'identity' else N_t
+    N_s = min(N_r, N_t) if config.precoder != 'identity' else N_t
 
-    if max_transmissions < 300:
+    if config.max_transmissions < 300:
         print('WARNING:  Low number of runs could cause statistically inaccurate results.')
 
     alphabet = create_constellation(constellation=constellation, M=M_constellation)
-    _plot_constellation(alphabet, annotate=True, filename='constellation')
+    _plot_constellation(alphabet.to_dataframe(), annotate=True, filename='constellation')
 
     k_constellation = int(np.log2(M_constellation))
 
-    X_information, X, [x_b_i, x_b_q], payload_size, crc_transmitter = generate_transmit_symbols(N_sc, N_s, alphabet=alphabet, P_TX=P_TX)
+    X_information, X, [x_b_i, x_b_q], payload_size, crc_transmitter = \
+        generate_transmit_symbols(N_sc, N_s, alphabet=alphabet, P_TX=P_TX, crc_generator=crc_generator,
+                                  random_state=config.np_random)
     bits_transmitter, codeword_transmitter = bits_from_IQ(x_b_i, x_b_q)
-    P_X = np.mean(_signal_power(X)) * Df
 
-    P = generate_pilot_symbols(N_t, n_pilot, P_TX, kind='dft')
-    H = create_channel(N_sc, N_r, N_t, channel=channel_type, shadow_fading_margin_dB=8)
+    P = generate_pilot_symbols(N_t, config.n_pilot, P_TX, kind='dft', random_state=config.np_random)
+    # The simulation keeps frequency-flat channels as read-only views.
+    H = _create_channel_batch(1, N_sc, N_r, N_t, channel=config.channel_type, shadow_fading_margin_dB=8,
+                              config=config)[0]
 
     # Precoder and combiner
-    F, Gcomb = compute_precoder_combiner(H, P_BS, algorithm=precoder)
+    F, Gcomb = compute_precoder_combiner(H, config.P_BS, algorithm=config.precoder, config=config)
 
     # Precoding right-multiply H with F
-    HF = H@F
+    HF = _channel_product(H, F) if F.ndim == 3 else H@F
 
     # The throughput can be computed by dividing the payload size by TTI (= 1 symbol duration)
     print(f'Payload to be transmitted: {payload_size} bits over one OFDM symbol duration (including CRC).')
 
-    if precoder != 'dft_beamforming':
+    if config.precoder != 'dft_beamforming':
         print('Channel eigenmodes are: {}'.format(_find_channel_eigenmodes(H)))
 
-    plot_channel(H, filename=channel_type)
+    plot_channel(H, filename=config.channel_type)
+
+    columns = ['snr_dB', 'n', 'EbN0_dB', 'snr_transmitter_dB',
+               'channel_estimation_error', 'compression_loss',
+               'PL_dB', 'sinr_receiver_after_eq_dB',
+               'BER', 'BLER', 'BLER_lower', 'BLER_upper']
+
+    # The results are filled in place (one row per SNR point and, for the detailed
+    # results, one column per transmission) and become data frames once at the end.
+    n_snr = len(transmit_SNR_dB)
+    results = np.full((n_snr, len(columns)), np.nan)
+
+    detailed_columns = ['snr_dB', 'n', 'EbN0_dB', 'snr_transmitter_dB',
+                        'channel_estimation_error', 'compression_loss',
+                        'PL_dB', 'sinr_receiver_after_eq_dB',
+                        'BER', 'total_block_errors']
+    detailed_results = {column: np.full((n_snr, config.max_transmissions), np.nan, dtype=np.float32)
+                        for column in detailed_columns}
+    detailed_results['n'] = np.broadcast_to(np.arange(config.max_transmissions), (n_snr, config.max_transmissions))
+    detailed_results['total_block_errors'] = np.zeros((n_snr, config.max_transmissions), dtype=np.int64)
+
+    n_transmissions = np.zeros(n_snr, dtype=int)
+
+    print(' | '.join(columns))
+
+    # Every SNR point draws from its own stream spawned from the configured one,
+    # so the results do not depend on the number of workers.
+    seed_sequences = np.random.SeedSequence(config.np_random.randint(2 ** 32, size=4, dtype=np.uint32)).spawn(n_snr)
+
+    # H, F and Gcomb are fixed during the sweep, so the channel-dependent
+    # quantities are shared by the SNR points run in this process.
+    simulate = partial(_simulate_snr_point, H=H, HF=HF, F=F, Gcomb=Gcomb, X=X, P=P, alphabet=alphabet,
+                       codeword_transmitter=codeword_transmitter, crc_generator=crc_generator, config=config,
+                       coherence_block=CoherenceBlockCache())
+
+    # Only the SNR points that are not in the checkpoint are run.
+    pending = [item for item in range(n_snr) if item not in checkpoint['outcomes']]
+    pending_SNR_dB = [transmit_SNR_dB[item] for item in pending]
+    pending_seed_sequences = [seed_sequences[item] for item in pending]
+
+    # The SNR points are independent and can run on a pool of processes.
+    if config.n_workers > 1 and len(pending) > 0:
+        # Spawned rather than forked workers, since TensorFlow is not fork-safe.
+        executor = ProcessPoolExecutor(max_workers=config.n_workers, initializer=_limit_blas_threads,
+                                       mp_context=multiprocessing.get_context('spawn'))
+        outcomes = executor.map(simulate, pending_SNR_dB, pending_seed_sequences)
+    else:
+        executor = None
+        outcomes = map(simulate, pending_SNR_dB, pending_seed_sequences)
 
-    df = pd.DataFrame(columns=['snr_dB', 'n', 'EbN0_dB', 'snr_transmitter_dB',
-                               'channel_estimation_error', 'compression_loss',
-                               'PL_dB', 'sinr_receiver_after_eq_dB',
-                               'BER', 'BLER'])
+    # The pool is shut down even if a point fails or the sweep is interrupted.
+    try:
+        for item, snr_dB in enumerate(transmit_SNR_dB):
+            if item in checkpoint['outcomes']:
+                outcome = checkpoint['outcomes'][item]
+            else:
+                outcome = next(outcomes)
+                checkpoint['outcomes'][item] = outcome
+                _save_checkpoint(checkpoint_file, checkpoint)
 
-    df_detailed = df.copy().rename({'BLER': 'total_block_errors'}, axis=1)
-    df.drop(columns='n', inplace=True)
+            measurements, block_errors, BER_i, Y, GH_estF = outcome
 
-    print(' | '.join(df.columns))
+            # The number of transmissions run before stopping.
+            n = len(block_errors)
 
-    for item, snr_dB in enumerate(transmit_SNR_dB):
-        block_error = 0
-        BER = []
+            if item % 2 == 0:
+                _print_divider()
 
-        if item % 2 == 0:
-            _print_divider()
+            EbN0_dB = snr_dB - _dB(k_constellation)
 
-        EbN0_dB = snr_dB - _dB(k_constellation)
+            for column, values in measurements.items():
+                detailed_results[column][item, :n] = values
 
-        for n_transmission in range(max_transmissions):
-            Y, noise = channel_effect(HF, X, snr_dB)
-            T, _ = channel_effect(HF[:P.shape[0], :], P, snr_dB)
+            detailed_results['snr_dB'][item] = snr_dB
+            detailed_results['EbN0_dB'][item] = EbN0_dB
+            detailed_results['BER'][item, :n] = BER_i
+            detailed_results['total_block_errors'][item, :n] = np.cumsum(block_errors)
 
-            # Interference
-            interference = generate_interference(Y, p_interference, interference_power_dBm)
-            Y += interference
+            BER = np.mean(BER_i)
+            BLER = np.sum(block_errors) / n
+            BLER_lower, BLER_upper = _wilson_interval(np.sum(block_errors), n, config.confidence_level)
 
-            # Left-multiply y and noise with Gcomb
-            Y = _matrix_vector_multiplication(Gcomb, Y)
-            noise = _matrix_vector_multiplication(Gcomb, noise)
+            # The channel measurements are reported for the last transmission.
+            results[item] = [snr_dB, n, EbN0_dB] + [values[-1] for values in measurements.values()] + \
+                [BER, BLER, BLER_lower, BLER_upper]
+            n_transmissions[item] = n
 
-            P_Y = np.mean(_signal_power(Y)) * Df
-            P_noise = np.mean(_signal_power(noise)) * Df
+            rounded = [f'{x:.3f}' for x in results[item]]
 
-            # Quantization is optional.
-            Y = quantize(Y, b=quantization_b)
+            print(' | '.join(map(str, rounded)))
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
 
-            P_Y = np.mean(_signal_power(Y)) * Df
+    # The sweep is complete.
+    if checkpoint_file is not None and os.path.exists(checkpoint_file):
+        os.remove(checkpoint_file)
 
-            PL_dB = _dB(P_X) - _dB(P_Y)
+    df = pd.DataFrame(results, columns=columns)
+    # Only the transmissions that were run.
+    run = detailed_results['n'] < n_transmissions[:, np.newaxis]
+    df_detailed = pd.DataFrame({column: detailed_results[column][run] for column in detailed_columns})
 
-            snr_transmitter_dB = _dB(P_X/P_noise) # This should be very close to snr_dB.
-            # EbN0_transmitter_dB = snr_transmitter_dB - _dB(k_constellation)
+    end_time = time.time()
 
-            # Estimate from pilots
-            H_est = H if MIMO_estimation == 'perfect' else estimate_channel(P, T, snr_dB, algorithm=MIMO_estimation)
-            estimation_error = _mse(H, H_est)
+    # Plots
+    # noise after quantization for last run
+    GHFX, _ = channel_effect(GH_estF, X, snr_dB, config=config)
+    plot_pdf(Y - GHFX, text='noise', algorithm='KDE', filename='noise_alt')
 
-            # Compress channel before sending to the receiver
-            # and only plot the first transmission (since all transmissions are assumed within channel coherence time).
-            _, H_est, compression_loss = compress_channel(H_est, channel_compression_ratio, quantization_b, plotting=(n_transmission == 0))
+    # Plot a quantized signal of the last run
+    plot_IQ(Y, filename='IQ')
 
-            # Replace the channel H with Sigma as a result of the operations on
-            # X and Y above.
-            GH_estF = Gcomb@H_est@F # This is Sigma.  Is it diagonalized with elements equal the sqrt of eigenmodes?  Yes.
-            # np.sqrt(_find_channel_eigenmodes(H)) == GH_estF[0].round(4)
+    # Plot the SNR distribution for a given transmitted SNR
+    plot_pdf(df_detailed.loc[df_detailed['snr_dB'] == 30, 'sinr_receiver_after_eq_dB'], text='SINR receiver', num_bins=12,
+             filename='sinr', algorithm='empirical')
+    plot_pdf(df_detailed.loc[df_detailed['snr_dB'] == 30, 'sinr_receiver_after_eq_dB'].values, text='SINR receiver',
+             filename='sinr_kde', algorithm='KDE')
+    ###########################################################################
 
-            if (channel_compression_ratio == 0) and ((precoder == 'SVD') or (precoder == 'SVD_Waterfilling')):
-                assert np.allclose(GH_estF[0], np.diag(np.diagonal(GH_estF[0])))
+    _print_divider()
+    print(f'Time elapsed: {((end_time - start_time) / 60.):.2f} mins.')
 
-            if precoder != 'dft_beamforming':
-                W = equalize_channel(GH_estF, snr_dB, algorithm=MIMO_equalization)
-            else:
-                W = np.ones((N_t, N_sc)) # no equalization necessary for beamforming.
+    return df, df_detailed
 
-            # # Note:  Often, keep an eye on the product (W@GH_estF).round(1) and see how close it is to I.
-            # if not np.allclose((W@GH_estF)[0].round(1), np.eye(N_t)):
-            #     print("WARNING")
 
-            z = _matrix_vector_multiplication(W, Y)
-            v = _matrix_vector_multiplication(W, noise)
-            q = _matrix_vector_multiplication(W, interference)
+def _simulate_snr_point(snr_dB, seed_sequence, H, HF, F, Gcomb, X, P, alphabet,
+                        codeword_transmitter, crc_generator, config, coherence_block=None):
+    # All the transmissions of one SNR point, drawing from the stream seed_sequence.
+    # Returns the measurements and errors of every transmission and the
+    # last received signal and effective channel for plotting.
+    config = copy.copy(config)
+    config.np_random = np.random.RandomState(np.random.MT19937(seed_sequence))
+    coherence_block = CoherenceBlockCache() if coherence_block is None else coherence_block
+
+    N_sc = X.shape[0]
+    k_constellation = alphabet.k
+    payload_size = codeword_transmitter.shape[-1]
+    P_X = np.mean(_signal_power(X)) * config.Df
+
+    # Remove the padding and CRC from the codewords when scoring.
+    crc_length = crc_generator.bit_length() - 1
+    crc_pad_length = int(np.ceil(crc_length / k_constellation)) * \
+        k_constellation  # padding included.
+
+    # Output buffers reused by every batch of transmissions: (batch, N_sc, ...).
+    N_y = HF.shape[-2] if HF.ndim == 3 else 1
+    received = np.empty((config.transmission_batch_size, N_sc, N_y), dtype=np.complex128)
+    pilots_received = np.empty((config.transmission_batch_size,) + ((P.shape[0], N_y) if HF.ndim == 3 else P.shape), dtype=np.complex128)
+    Y_comb = np.empty((config.transmission_batch_size, N_sc, N_y), dtype=np.complex128)
+    noise_comb = np.empty((config.transmission_batch_size, N_sc, N_y), dtype=np.complex128)
+    z = np.empty((config.transmission_batch_size,) + X.shape, dtype=np.complex128)
+    v = np.empty((config.transmission_batch_size,) + X.shape, dtype=np.complex128)
+    q = np.empty((config.transmission_batch_size,) + X.shape, dtype=np.complex128)
+
+    codewords_receiver = np.zeros((config.max_transmissions, payload_size), dtype=np.uint8)
+
+    # Measurements and errors of every transmission.
+    snr_transmitter_dB = np.empty(config.max_transmissions)
+    estimation_error = np.empty(config.max_transmissions)
+    compression_loss = np.empty(config.max_transmissions)
+    PL_dB = np.empty(config.max_transmissions)
+    sinr_receiver_after_eq_dB = np.empty(config.max_transmissions)
+
+    block_errors = np.zeros(config.max_transmissions, dtype=bool)
+    bit_errors = 0
+
+    # For beamforming, the codeword is actually one symbol, and thus
+    # bit error rate will be filled with NaN
+    BER_i = np.full(config.max_transmissions, np.nan)
+
+    # The transmissions are simulated as a batch on the leading axis,
+    # transmission_batch_size of them at a time, until a stopping rule is met.
+    for start in range(0, config.max_transmissions, config.transmission_batch_size):
+        end = min(start + config.transmission_batch_size, config.max_transmissions)
+        n_batch = end - start
+
+        X_batch = np.broadcast_to(X, (n_batch,) + X.shape)
+        P_batch = np.broadcast_to(P, (n_batch,) + P.shape)
+
+        Y, noise = channel_effect(HF, X_batch, snr_dB, out=received[:n_batch], config=config)
+        T, _ = channel_effect(HF[:P.shape[0], :], P_batch, snr_dB, out=pilots_received[:n_batch], config=config)
+
+        # Interference
+        interference = generate_interference(Y, config.p_interference, config.interference_power_dBm,
+                                             random_state=config.np_random)
+        Y += interference
+
+        # Left-multiply y and noise with Gcomb
+        Y = _matrix_vector_multiplication(Gcomb, Y, out=Y_comb[:n_batch])
+        noise = _matrix_vector_multiplication(Gcomb, noise, out=noise_comb[:n_batch])
+
+        P_noise = _average_power(noise) * config.Df
+
+        # Quantization is optional.
+        Y = quantize(Y, b=config.quantization_b)
+
+        P_Y = _average_power(Y) * config.Df
+
+        PL_dB[start:end] = _dB(P_X) - _dB(P_Y)
+
+        snr_transmitter_dB[start:end] = _dB(P_X/P_noise) # This should be very close to snr_dB.
+        # EbN0_transmitter_dB = snr_transmitter_dB - _dB(k_constellation)
+
+        # With perfect knowledge, the channel-dependent stages do not change within
+        # the coherence block and are computed once.  Estimates from pilots are
+        # noisy and are processed for every transmission.
+        if config.MIMO_estimation == 'perfect':
+            H_est, estimation_error[start:end], compression_loss[start:end], GH_estF = \
+                coherence_block.get(H, 'effective_channel', lambda: _process_channel_estimate(H, H, Gcomb, F, config, plotting=(start == 0)))
+            W = coherence_block.get(H, ('equalizer', snr_dB), lambda: _equalizer(GH_estF, snr_dB, N_sc, config))
+        else:
+            H_est = estimate_channel(P, T, snr_dB, algorithm=config.MIMO_estimation, N_sc=N_sc, config=config)
+            H_est, estimation_error[start:end], compression_loss[start:end], GH_estF = \
+                _process_channel_estimate(H, H_est, Gcomb, F, config, plotting=(start == 0))
+            W = _equalizer(GH_estF, snr_dB, N_sc, config)
+
+        # # Note:  Often, keep an eye on the product (W@GH_estF).round(1) and see how close it is to I.
+        # if not np.allclose((W@GH_estF)[0].round(1), np.eye(N_t)):
+        #     print("WARNING")
+
+        _matrix_vector_multiplication(W, Y, out=z[:n_batch])
+        _matrix_vector_multiplication(W, noise, out=v[:n_batch])
+        _matrix_vector_multiplication(W, interference, out=q[:n_batch])
+
+        P_z = _average_power(z[:n_batch]) * config.Df
+        P_v = _average_power(v[:n_batch]) * config.Df
+        P_q = _average_power(q[:n_batch]) * config.Df
+
+        sinr_receiver_after_eq_dB[start:end] = _dB(P_z/(P_v + P_q))
+
+        # Now conduct symbol detection to find x hat from z.
+        X_hat_information, X_hat, [x_hat_b_i, x_hat_b_q] = detect_symbols(z[:n_batch], alphabet, algorithm=config.symbol_detection,
+                                                                      config=config)
+
+        bits_receiver, codewords_receiver[start:end, :] = bits_from_IQ(x_hat_b_i, x_hat_b_q)
+
+        # Score all the transmissions of this batch in one call.
+        # Remove the padding and CRC from here.
+        payloads_receiver = codewords_receiver[start:end, :-crc_pad_length]
+
+        # Performance measures are here.
+        # If the CRC computed at the receiver differs from the received CRC, then error.
+        crc_receiver = compute_crc(payloads_receiver, crc_generator)
+        block_errors[start:end] = np.any(crc_receiver != codewords_receiver[start:end, -crc_length:], axis=1)
+
+        if config.precoder != 'dft_beamforming':
+            bit_errors_i, bit_errors_batch = count_bit_errors(codeword_transmitter[:-crc_pad_length], payloads_receiver)
+            BER_i[start:end] = bit_errors_i / payloads_receiver.shape[-1]
+            bit_errors += bit_errors_batch
+
+        n_transmissions = end
+        if _stop_transmissions(np.sum(block_errors[:end]), bit_errors, n_transmissions, config):
+            break
+        ###########################################################################
+
+    measurements = {'snr_transmitter_dB': snr_transmitter_dB[:n_transmissions],
+                    'channel_estimation_error': estimation_error[:n_transmissions],
+                    'compression_loss': compression_loss[:n_transmissions],
+                    'PL_dB': PL_dB[:n_transmissions],
+                    'sinr_receiver_after_eq_dB': sinr_receiver_after_eq_dB[:n_transmissions]}
+
+    # The last transmission
+    if H_est.ndim > H.ndim:
+        GH_estF = GH_estF[-1]
+
+    return measurements, block_errors[:n_transmissions], BER_i[:n_transmissions], Y[-1], GH_estF
+
+
+def _process_channel_estimate(H, H_est, Gcomb, F, config, plotting=False):
+    # The channel-dependent stages after estimation: the estimation error,
+    # the compressed estimate and the effective channel Gcomb H_est F.
+    estimation_error = _mse(H, H_est, axis=(-3, -2, -1))
+
+    # Compress channel before sending to the receiver
+    # and only plot the first transmissions (since all transmissions are assumed within channel coherence time).
+    _, H_est, compression_loss = compress_channel(H_est, config.channel_compression_ratio, config.quantization_b, plotting=plotting,
+                                                 config=config)
+
+    # Replace the channel H with Sigma as a result of the operations on
+    # X and Y above.
+    # For beamforming, F is a vector and Gcomb a gain per subcarrier, so the
+    # effective channel is one scalar per subcarrier: (..., N_sc, 1).
+    if F.ndim == 1:
+        GH_estF = Gcomb * (H_est @ F)
+    else:
+        GH_estF = _channel_product(Gcomb, H_est, F) # This is Sigma.  Is it diagonalized with elements equal the sqrt of eigenmodes?  Yes.
+    # np.sqrt(_find_channel_eigenmodes(H)) == GH_estF[0].round(4)
 
-            P_z = np.mean(_signal_power(z)) * Df
-            P_v = np.mean(_signal_power(v)) * Df
-            P_q = np.mean(_signal_power(q)) * Df
+    if (config.channel_compression_ratio == 0) and ((config.precoder == 'SVD') or (config.precoder == 'SVD_Waterfilling')):
+        Sigma = GH_estF[..., 0, :, :]
+        assert np.allclose(Sigma, Sigma * np.eye(*Sigma.shape[-2:]))
 
-            sinr_receiver_after_eq_dB = _dB(P_z/(P_v + P_q))
+    return H_est, estimation_error, compression_loss, GH_estF
 
-            # Now conduct symbol detection to find x hat from z.
-            X_hat_information, X_hat, [x_hat_b_i, x_hat_b_q] = detect_symbols(z, alphabet, algorithm=symbol_detection)
 
-            bits_receiver, codeword_receiver = bits_from_IQ(x_hat_b_i, x_hat_b_q)
+def _equalizer(GH_estF, snr_dB, N_sc, config):
+    # For beamforming, a scalar equalizer per subcarrier removes the complex
+    # gain of the beamformed channel (..., N_sc, 1), taken as 1 x 1 matrices.
+    if config.precoder == 'dft_beamforming':
+        return equalize_channel(GH_estF[..., np.newaxis], snr_dB, algorithm=config.MIMO_equalization)
 
-            # Remove the padding and CRC from here.
-            crc_length = len(crc_transmitter)
-            crc_pad_length = int(np.ceil(crc_length / k_constellation)) * \
-                k_constellation  # padding included.
+    return equalize_channel(GH_estF, snr_dB, algorithm=config.MIMO_equalization)
 
-            codeword_receiver = codeword_receiver[:-crc_pad_length]
 
-            # Performance measures are here.
-            crc_receiver = compute_crc(codeword_receiver, crc_generator)
-            # import pdb; pdb.set_trace()
-            # If CRC1 xor CRC2 is not zero, then error.
-            if int(crc_transmitter, 2) ^ int(crc_receiver, 2) != 0:
-                block_error += 1
+def _load_checkpoint(filename):
+    if not os.path.exists(filename):
+        return None
 
-            # For beamforming, the codeword is actually one symbol, and thus
-            # bit error rate will be filled with NaN
-            BER_i = np.nan
-            if precoder != 'dft_beamforming':
-                BER_i = compute_bit_error_rate(codeword_transmitter[:-crc_pad_length], codeword_receiver)
-            BER.append(BER_i)
+    with open(filename, 'rb') as f:
+        return pickle.load(f)
 
-            to_append_i = [snr_dB, n_transmission, EbN0_dB, snr_transmitter_dB, estimation_error, compression_loss,
-                           PL_dB, sinr_receiver_after_eq_dB, BER_i, block_error]
-            df_to_append_i = pd.DataFrame([to_append_i], columns=df_detailed.columns)
 
-            if df_detailed.shape[0] == 0:
-                df_detailed = df_to_append_i.copy()
-            else:
-                df_detailed = pd.concat([df_detailed, df_to_append_i], ignore_index=True, axis=0)
-            ###########################################################################
+def _save_checkpoint(filename, checkpoint):
+    if filename is None:
+        return
 
-        BER = np.mean(BER)
-        BLER = block_error / max_transmissions
+    os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
 
-        to_append = [snr_dB, EbN0_dB, snr_transmitter_dB, estimation_error, compression_loss, PL_dB, sinr_receiver_after_eq_dB, BER, BLER]
-        df_to_append = pd.DataFrame([to_append], columns=df.columns)
+    # Write to a temporary file first so that a crash never leaves a partial checkpoint.
+    with open(f'{filename}.tmp', 'wb') as f:
+        pickle.dump(checkpoint, f)
+    os.replace(f'{filename}.tmp', filename)
 
-        rounded = [f'{x:.3f}' for x in to_append]
-        del to_append
 
-        if df.shape[0] == 0:
-            df = df_to_append.copy()
-        else:
-            df = pd.concat([df, df_to_append], ignore_index=True, axis=0)
+def _stop_transmissions(block_errors, bit_errors, n, config):
+    # Enough errors have been counted, or the BLER is known precisely enough.
+    if block_errors >= config.target_block_errors or bit_errors >= config.target_bit_errors:
+        return True
 
-        print(' | '.join(map(str, rounded)))
+    if block_errors == 0:
+        return False
 
-    end_time = time.time()
+    BLER_lower, BLER_upper = _wilson_interval(block_errors, n, config.confidence_level)
 
-    # Plots
-    # noise after quantization for last run
-    GHFX, _ = channel_effect(GH_estF, X, snr_dB)
-    plot_pdf(Y - GHFX, text='noise', algorithm='KDE', filename='noise_alt')
+    return (BLER_upper - BLER_lower) / 2 <= config.bler_relative_precision * block_errors / n
 
-    # Plot a quantized signal of the last run
-    plot_IQ(Y, filename='IQ')
 
-    # Plot the SNR distribution for a given transmitted SNR
-    plot_pdf(df_detailed.loc[df_detailed['snr_dB'] == 30, 'sinr_receiver_after_eq_dB'], text='SINR receiver', num_bins=12,
-             filename='sinr', algorithm='empirical')
-    plot_pdf(df_detailed.loc[df_detailed['snr_dB'] == 30, 'sinr_receiver_after_eq_dB'].values, text='SINR receiver',
-             filename='sinr_kde', algorithm='KDE')
-    ###########################################################################
+def _wilson_interval(errors, n, confidence_level=0.95):
+    # Wilson score interval of the error probability from errors out of n trials.
+    z = norm.ppf(0.5 + confidence_level / 2)
+    p = errors / n
 
-    _print_divider()
-    print(f'Time elapsed: {((end_time - start_time) / 60.):.2f} mins.')
+    denominator = 1 + z ** 2 / n
+    center = (p + z ** 2 / (2 * n)) / denominator
+    half_width = z * np.sqrt(p * (1 - p) / n + z ** 2 / (4 * n ** 2)) / denominator
 
-    return df, df_detailed
+    return center - half_width, center + half_width
+
+
+# Jobs of the scikit-learn estimators (-1: all cores).
+_n_jobs = -1
+
+
+def _limit_blas_threads(n_threads=1):
+    # Pin the BLAS threads and the scikit-learn jobs of a worker process
+    # so that the workers do not oversubscribe the cores.
+    global _n_jobs
+
+    threadpool_limits(limits=n_threads)
+    _n_jobs = n_threads
 
 
 def rotation_channel(X, theta=0, SNR_dB=30, noise='shot'):
@@ -2206,7 +2972,7 @@ def equalize_rotation_channel_CNN(theta, SNR_dB, epochs=100, batch_size=64, trai
     training_size = 10000  # in symbols
 
     # These are pilots.
-    _, X_clean, _, _, _ = generate_transmit_symbols(training_size, 1, alphabet, 1)
+    _, X_clean, _, _, _ = generate_transmit_symbols(training_size, 1, alphabet, 1, crc_generator)
 
     X_clean = X_clean.flatten() # ravel()
     X, y = rotation_channel(X_clean, theta=theta, SNR_dB=SNR_dB)  # SNR dB and a rotation of 7.5 deg.
@@ -2267,68 +3033,70 @@ def equalize_rotation_channel_CNN(theta, SNR_dB, epochs=100, batch_size=64, trai
 # interested in running.
 ###############################################################################
 
-# Model-based and machine learning (supervised, unsupervised) simulations
-###############################################################################
-df_results, df_detailed_results = run_simulation(transmit_SNR_dB,
-                                                  constellation,
-                                                  M_constellation, crc_generator,
-                                                  N_sc, N_r, N_t)
-
-plot_performance(df_results, xlabel='EbN0_dB', ylabel='BER', semilogy=True, filename='BER')
-plot_performance(df_results, xlabel='EbN0_dB', ylabel='BLER', semilogy=True, filename='BLER')
-###############################################################################
-
-# CNN-based equalization
-###############################################################################
-X_test, y_test, y_pred = equalize_rotation_channel_CNN(theta=np.pi/24, SNR_dB=30,
-                                                           epochs=96, batch_size=32,
-                                                           training_ratio=0.85)
-###############################################################################
-
-# Time series predictions
-###############################################################################
-y_test_pred, test_accuracy_score = predict_trajectory_with_LSTM(df=None,
-                             target_variable='', depth=0, width=10,
-                             lookahead_time=1, max_lookback=10,
-                             training_size=0.1, batch_size=32,
-                             epoch_count=50)
-###############################################################################
-
-# Tabular reinforcement learning simulation
-###############################################################################
-Q_values, losses, optimal_episode, optimal_reward, \
-    optimal_environment_progress, optimal_action_progress = \
-        _tabular_reinforcement_learning(max_episodes_to_run=100,
-                                        max_timesteps_per_episode=15,
-                                        plotting=True)
-###############################################################################
-
-# Deep reinforcement learning simulation
-###############################################################################
-Q_values, losses, optimal_episode, optimal_reward, \
-    optimal_environment_progress, optimal_action_progress = \
-    _deep_reinforcement_learning(max_episodes_to_run=200,
-                                 max_timesteps_per_episode=15,
-                                 plotting=True)
-###############################################################################
-
-# Using linear regresion for channel estimation.
-###############################################################################
-X = np_random.uniform(-1, 1, N_sc)
-X /= np.sqrt(_signal_power(X))
-
-X = np.repeat(X, N_t, axis=np.newaxis).reshape((N_sc, N_t))
-H = np.tile(np.ones((N_r, N_t)), N_sc).reshape((N_sc, N_r, N_t))
-
-Hx = np.zeros((N_sc, N_r))
-for idx in range(N_sc):
-    Hx[idx, :] = np.dot(H[idx, :, :], X[idx, :])
+# Worker processes of the parallel SNR sweep import this module without running the scenarios.
+if __name__ == '__main__':
+    # Model-based and machine learning (supervised, unsupervised) simulations
+    ###############################################################################
+    df_results, df_detailed_results = run_simulation(transmit_SNR_dB,
+                                                      constellation,
+                                                      M_constellation, crc_generator,
+                                                      N_sc, N_r, N_t)
+
+    plot_performance(df_results, xlabel='EbN0_dB', ylabel='BER', semilogy=True, filename='BER')
+    plot_performance(df_results, xlabel='EbN0_dB', ylabel='BLER', semilogy=True, filename='BLER')
+    ###############################################################################
+
+    # CNN-based equalization
+    ###############################################################################
+    X_test, y_test, y_pred = equalize_rotation_channel_CNN(theta=np.pi/24, SNR_dB=30,
+                                                               epochs=96, batch_size=32,
+                                                               training_ratio=0.85)
+    ###############################################################################
+
+    # Time series predictions
+    ###############################################################################
+    y_test_pred, test_accuracy_score = predict_trajectory_with_LSTM(df=None,
+                                 target_variable='', depth=0, width=10,
+                                 lookahead_time=1, max_lookback=10,
+                                 training_size=0.1, batch_size=32,
+                                 epoch_count=50)
+    ###############################################################################
+
+    # Tabular reinforcement learning simulation
+    ###############################################################################
+    Q_values, losses, optimal_episode, optimal_reward, \
+        optimal_environment_progress, optimal_action_progress = \
+            _tabular_reinforcement_learning(max_episodes_to_run=100,
+                                            max_timesteps_per_episode=15,
+                                            plotting=True)
+    ###############################################################################
+
+    # Deep reinforcement learning simulation
+    ###############################################################################
+    Q_values, losses, optimal_episode, optimal_reward, \
+        optimal_environment_progress, optimal_action_progress = \
+        _deep_reinforcement_learning(max_episodes_to_run=200,
+                                     max_timesteps_per_episode=15,
+                                     plotting=True)
+    ###############################################################################
+
+    # Using linear regresion for channel estimation.
+    ###############################################################################
+    X = np_random.uniform(-1, 1, N_sc)
+    X /= np.sqrt(_signal_power(X))
+
+    X = np.repeat(X, N_t, axis=np.newaxis).reshape((N_sc, N_t))
+    H = np.tile(np.ones((N_r, N_t)), N_sc).reshape((N_sc, N_r, N_t))
+
+    Hx = np.zeros((N_sc, N_r))
+    for idx in range(N_sc):
+        Hx[idx, :] = np.dot(H[idx, :, :], X[idx, :])
 
-SNR_dB = 10
-noise_power = 1 / _linear(SNR_dB)
-y = Hx + np_random.normal(0, noise_power, (N_sc, N_r))
+    SNR_dB = 10
+    noise_power = 1 / _linear(SNR_dB)
+    y = Hx + np_random.normal(0, noise_power, (N_sc, N_r))
 
-H_est = _estimate_channel_linear_regression(X, y)
+    H_est = _estimate_channel_linear_regression(X, y, N_sc)
 
-estimation_error = _mse(H, H_est)
-print(f'Using linear regression, estimation error is: {estimation_error:.4f}.')
+    estimation_error = _mse(H, H_est)
+    print(f'Using linear regression, estimation error is: {estimation_error:.4f}.')